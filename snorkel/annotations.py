@@ -1,15 +1,17 @@
 import numpy as np
 from pandas import DataFrame, Series
 import scipy.sparse as sparse
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from sqlalchemy.sql import bindparam, select
 import inspect
 
 from .features import get_span_feats
 from .models import (
     GoldLabel, GoldLabelKey, Label, LabelKey, Feature, FeatureKey, Candidate,
-    Marginal
+    Marginal, Span
 )
-from .models.meta import new_sessionmaker
+from .models.meta import IN_QUERY_SIZE, autocommits, new_sessionmaker, snorkel_postgres
 from .udf import UDF, UDFRunner
 from .utils import (
     matrix_conflicts,
@@ -18,7 +20,9 @@ from .utils import (
     matrix_tp,
     matrix_fp,
     matrix_fn,
-    matrix_tn
+    matrix_tn,
+    paged_query,
+    batch_iter
 )
 
 
@@ -132,27 +136,43 @@ class Annotator(UDFRunner):
                                         f_gen=f_gen)
 
     def apply(self, split=0, key_group=0, replace_key_set=True, cids_query=None,
-        **kwargs):
+        stream=False, checkpoint=None, **kwargs):
+        """
+        :param stream: If True, the candidate ids are loaded lazily, page by page, while the UDF
+            runs, rather than all up front; cids_query must then select Candidate.id first, and
+            not have an ORDER BY, LIMIT or OFFSET applied.
+        :param checkpoint: If set, the name of a progress ledger from which to resume an interrupted
+            run; see UDFRunner.apply.
+        """
         # If we are replacing the key set, make sure the reducer key id cache is cleared!
+        SnorkelSession = new_sessionmaker()
+        session = SnorkelSession()
         if replace_key_set:
             self.reducer.key_cache = {}
 
+            # If resuming, the keys inserted so far are kept, so must be in the cache
+            if checkpoint is not None and self.has_checkpoint(checkpoint):
+                keys = session.query(self.annotation_key_class.name, self.annotation_key_class.id)\
+                              .filter(self.annotation_key_class.group == key_group).all()
+                self.reducer.key_cache = dict(keys)
+
         # Get the cids based on the split, and also the count
-        SnorkelSession = new_sessionmaker()
-        session = SnorkelSession()
         cids_query = cids_query or session.query(Candidate.id)\
                                           .filter(Candidate.split == split)
 
-        # Note: In the current UDFRunner implementation, we load all these into memory and fill a
-        # multiprocessing JoinableQueue with them before starting... so might as well load them here and pass in.
-        # Also, if we try to pass in a query iterator instead, with AUTOCOMMIT on, we get a TXN error...
-        cids       = cids_query.all()
-        cids_count = len(cids)
-        
-        # Run the Annotator
+        # Note: If we try to pass in a plain query iterator, with AUTOCOMMIT on, we get a TXN error...
+        # so when streaming we use keyset pagination, which holds no cursor open between pages
+        if stream:
+            cids_count = cids_query.count()
+            cids       = paged_query(cids_query.with_session(SnorkelSession()), Candidate.id)
+        else:
+            cids       = cids_query.all()
+            cids_count = len(cids)
+
+        # Run the Annotator; the counters and timings of the run are kept as self.stats
         super(Annotator, self).apply(cids, split=split, key_group=key_group,
             replace_key_set=replace_key_set, cids_query=cids_query, 
-            count=cids_count, **kwargs)
+            count=cids_count, checkpoint=checkpoint, **kwargs)
 
         # Load the matrix
         return self.load_matrix(session, split=split, cids_query=cids_query, 
@@ -215,15 +235,46 @@ class AnnotatorUDF(UDF):
         Note: Accepts a candidate _id_ as argument, because of issues with putting Candidate subclasses
         into Queues (can't pickle...)
         """
-        seen = set()
         cid = cid[0]
-        c    = self.session.query(Candidate).filter(Candidate.id == cid).one()
+        c   = self.session.query(Candidate).filter(Candidate.id == cid).one()
+        for y in self._annotate(c):
+            yield y
+
+    def apply_batch(self, cids, **kwargs):
+        """
+        Applies a given function to a batch of Candidates, loading them with a single IN query
+        (plus one for their Span arguments and the Sentences of these), rather than one query per id
+        """
+        ids        = [cid[0] for cid in cids]
+        candidates = self.session.query(Candidate).with_polymorphic('*')\
+                                 .filter(Candidate.id.in_(ids)).all()
+
+        # Load the Span arguments into the identity map, so that accessing them on the Candidates
+        # does not trigger a query; note we must hold on to them, as the identity map is weak-referencing
+        span_ids = set(getattr(c, arg + '_id') for c in candidates for arg in c.__argnames__)
+        spans    = self.session.query(Span).options(joinedload(Span.sentence))\
+                               .filter(Span.id.in_(span_ids)).all() if span_ids else []
+        for c in candidates:
+            for y in self._annotate(c):
+                yield y
+
+    def get_input_key(self, cid):
+        return str(cid[0])
+
+    def process_queue(self):
+        # If kept alive across runs, key ids cached in a previous run may be stale if its keys were replaced
+        self.key_cache = {}
+        return super(AnnotatorUDF, self).process_queue()
+
+    def _annotate(self, c):
+        """Yields the Annotations of Candidate c as (cid, key_name, value) tuples"""
+        seen = set()
         for key_name, value in self.anno_generator(c):
 
             # Note: Make sure no duplicates emitted here!
-            if (cid, key_name) not in seen:
-                seen.add((cid, key_name))
-                yield cid, key_name, value
+            if (c.id, key_name) not in seen:
+                seen.add((c.id, key_name))
+                yield c.id, key_name, value
 
     def reduce(self, y, clear, key_group, replace_key_set, **kwargs):
         """
@@ -291,6 +342,97 @@ class AnnotatorUDF(UDF):
                 self.session.execute(anno_insert_query, {'candidate_id': cid, 'key_id': key_id, 'value': value})
 
 
+    def reduce_batch(self, ys, clear, key_group, replace_key_set, **kwargs):
+        """
+        Inserts a batch of Annotations into the database, as with reduce, but looking up (or adding) their
+        AnnotationKeys together, and writing them with executemany INSERTs (and UPDATEs, if clear=False).
+        Is safe to run concurrently on disjoint sets of candidates, so that each UDF process can reduce its
+        own outputs.
+        """
+        if len(ys) == 0:
+            return
+        key_ids = self._get_key_ids(set(key_name for _, key_name, _ in ys), key_group, replace_key_set)
+
+        # Annotations with unseen AnnotationKeys are skipped if create_new_keyset = False
+        annos = [{'candidate_id': cid, 'key_id': key_ids[key_name], 'value': value}
+                 for cid, key_name, value in ys if key_name in key_ids]
+
+        # Annotations which might already exist need updating rather than inserting if clear=False
+        if not clear:
+            existing = set()
+            cids     = sorted(set(anno['candidate_id'] for anno in annos))
+            for cids_batch in batch_iter(cids, IN_QUERY_SIZE):
+                q = select([self.annotation_class.candidate_id, self.annotation_class.key_id])\
+                        .where(self.annotation_class.candidate_id.in_(cids_batch))
+                existing.update((cid, kid) for cid, kid in self.session.execute(q))
+            updates = [{'cid': anno['candidate_id'], 'kid': anno['key_id'], 'value': anno['value']}
+                       for anno in annos if (anno['candidate_id'], anno['key_id']) in existing]
+            annos   = [anno for anno in annos if (anno['candidate_id'], anno['key_id']) not in existing]
+            if len(updates) > 0:
+                anno_update_query = self.annotation_class.__table__.update()
+                anno_update_query = anno_update_query.where(self.annotation_class.candidate_id == bindparam('cid'))
+                anno_update_query = anno_update_query.where(self.annotation_class.key_id == bindparam('kid'))
+                anno_update_query = anno_update_query.values(value=bindparam('value'))
+                self.session.execute(anno_update_query, updates)
+
+        # Insert the new, non-zero Annotations
+        annos = [anno for anno in annos if anno['value'] != 0]
+        if len(annos) > 0:
+            self.session.execute(self.annotation_class.__table__.insert(), annos)
+
+    def _get_key_ids(self, key_names, key_group, replace_key_set):
+        """
+        Returns a dict of the ids of the named AnnotationKeys, via the key id cache; keys not yet in the
+        database are added if replace_key_set=True, and otherwise left out
+        """
+        missing = [key_name for key_name in key_names if key_name not in self.key_cache]
+        if len(missing) > 0:
+
+            # Keys may already exist in the DB if we are not replacing the key set, or if another UDF
+            # process has added them
+            key_select_query = select([self.annotation_key_class.name, self.annotation_key_class.id])\
+                                .where(self.annotation_key_class.name.in_(missing))
+            if key_group is not None:
+                key_select_query = key_select_query.where(self.annotation_key_class.group == key_group)
+            self.key_cache.update(dict(self.session.execute(key_select_query).fetchall()))
+
+            if replace_key_set:
+                key_insert_query = self.annotation_key_class.__table__.insert()
+                for key_name in missing:
+                    if key_name in self.key_cache:
+                        continue
+                    key_args = {'name': key_name, 'group': key_group} if key_group else {'name': key_name}
+                    key_id   = self._insert_key(key_insert_query, key_args)
+
+                    # Key was added concurrently by another UDF process
+                    if key_id is None:
+                        key_id = self.session.execute(key_select_query).fetchall()
+                        key_id = dict(key_id)[key_name]
+                    self.key_cache[key_name] = key_id
+        return dict((key_name, self.key_cache[key_name]) for key_name in key_names if key_name in self.key_cache)
+
+    def _insert_key(self, key_insert_query, key_args):
+        """
+        Inserts an AnnotationKey, returning its id, or None if it was added concurrently by another UDF process.
+        On conflict, only the INSERT is rolled back, not the keys and Annotations written before it in the
+        transaction: SQLite only aborts the failed statement, but Postgres aborts the whole transaction (e.g. when
+        flushing to a checkpoint), so there the INSERT is run in a SAVEPOINT, unless in AUTOCOMMIT mode
+        """
+        if not snorkel_postgres or autocommits(self.session):
+            try:
+                return self.session.execute(key_insert_query, key_args).inserted_primary_key[0]
+            except IntegrityError:
+                return None
+        savepoint = self.session.begin_nested()
+        try:
+            key_id = self.session.execute(key_insert_query, key_args).inserted_primary_key[0]
+        except IntegrityError:
+            savepoint.rollback()
+            return None
+        savepoint.commit()
+        return key_id
+
+
 def load_matrix(matrix_class, annotation_key_class, annotation_class, session,
     split=0, cids_query=None, key_group=0, key_names=None, zero_one=False,
     load_as_array=False):
@@ -4,8 +4,10 @@ from itertools import product
 import re
 from sqlalchemy.sql import select
 
-from .models import Candidate, TemporarySpan, Sentence
+from .models import Candidate, TemporarySpan, Sentence, load_context_ids
+from .models.meta import IN_QUERY_SIZE
 from .udf import UDF, UDFRunner
+from .utils import batch_iter
 
 QUEUE_COLLECT_TIMEOUT = 5
 
@@ -19,7 +21,8 @@ class CandidateExtractor(UDFRunner):
     :param cspaces: one or list of :class:`CandidateSpace` objects, one for each relation argument. Defines space of
                     Contexts to consider
     :param matchers: one or list of :class:`snorkel.matchers.Matcher` objects, one for each relation argument. Only tuples of
-                     Contexts for which each element is accepted by the corresponding Matcher will be returned as Candidates
+                     Contexts for which each element is accepted by the corresponding Matcher will be returned as Candidates.
+                     If None, all the Contexts of the candidate spaces are used, e.g. for :class:`DictionaryNgrams`
     :param self_relations: Boolean indicating whether to extract Candidates that relate the same context.
                            Only applies to binary relations. Default is False.
     :param nested_relations: Boolean indicating whether to extract Candidates that relate one Context with another
@@ -27,7 +30,7 @@ class CandidateExtractor(UDFRunner):
     :param symmetric_relations: Boolean indicating whether to extract symmetric Candidates, i.e., rel(A,B) and rel(B,A),
                                 where A and B are Contexts. Only applies to binary relations. Default is True.
     """
-    def __init__(self, candidate_class, cspaces, matchers, self_relations=False, nested_relations=False, symmetric_relations=True):
+    def __init__(self, candidate_class, cspaces, matchers=None, self_relations=False, nested_relations=False, symmetric_relations=True):
         super(CandidateExtractor, self).__init__(CandidateExtractorUDF,
                                                  candidate_class=candidate_class,
                                                  cspaces=cspaces,
@@ -37,17 +40,77 @@ class CandidateExtractor(UDFRunner):
                                                  symmetric_relations=symmetric_relations)
 
     def apply(self, xs, split=0, **kwargs):
-        super(CandidateExtractor, self).apply(xs, split=split, **kwargs)
+        return super(CandidateExtractor, self).apply(xs, split=split, **kwargs)
 
     def clear(self, session, split, **kwargs):
         session.query(Candidate).filter(Candidate.split == split).delete()
 
 
-class CandidateExtractorUDF(UDF):
+class CandidateExtractorUDFBase(UDF):
+    """
+    Base class of the candidate extractor UDFs, which extract Candidates from batches of Contexts, looking
+    up (or inserting) the argument TemporaryContexts of all of them together
+    """
+    def get_input_key(self, context):
+        return context.stable_id
+
+    def apply(self, context, clear, split, **kwargs):
+        return self.apply_batch([context], clear=clear, split=split, **kwargs)
+
+    def _candidates(self, candidates, contexts, check_for_existing):
+        """
+        Yields the Candidates of a batch, given as pairs of a dict of their other column values (e.g. split)
+        and a tuple of their argument TemporaryContexts, of which contexts are all those extracted, and
+        which are first loaded (or inserted) with one query per batch.
+
+        In single-writer mode, we only look up existing TemporaryContexts: the new ones are promoted once
+        each, and output too (before the Candidates), so that they are inserted by the parent process,
+        including those which are not part of any Candidate, as they are when writing from the UDF.
+        """
+        load_context_ids(self.session, contexts, insert=not self.single_writer)
+
+        # Assemble candidate arguments
+        promoted       = {}
+        candidate_args = []
+        for values, tcs in candidates:
+            args     = dict(values)
+            new_args = {}
+            for arg_name, tc in zip(self.candidate_class.__argnames__, tcs):
+                if tc.id is not None:
+                    args[arg_name + '_id'] = tc.id
+                else:
+                    if tc not in promoted:
+                        promoted[tc] = tc.promote()
+                    new_args[arg_name] = promoted[tc]
+            candidate_args.append((args, new_args))
+
+        # Checking for existence, with one query for the batch (Candidates with new Contexts cannot exist yet)
+        existing = set()
+        if check_for_existing:
+            existing = existing_candidates(self.session, self.candidate_class,
+                                           [args for args, new_args in candidate_args if len(new_args) == 0])
+
+        if self.single_writer:
+            for tc in new_contexts(contexts):
+                if tc not in promoted:
+                    promoted[tc] = tc.promote()
+                yield promoted[tc]
+
+        # Add Candidates to session
+        for args, new_args in candidate_args:
+            if len(new_args) == 0 and tuple(sorted(args.items())) in existing:
+                continue
+            args.update(new_args)
+            yield self.candidate_class(**args)
+
+
+class CandidateExtractorUDF(CandidateExtractorUDFBase):
     def __init__(self, candidate_class, cspaces, matchers, self_relations, nested_relations, symmetric_relations, **kwargs):
         self.candidate_class     = candidate_class
         self.candidate_spaces    = cspaces if type(cspaces) in [list, tuple] else [cspaces]
         self.matchers            = matchers if type(matchers) in [list, tuple] else [matchers]
+        if matchers is None:
+            self.matchers = [None] * len(self.candidate_spaces)
         self.nested_relations    = nested_relations
         self.self_relations      = self_relations
         self.symmetric_relations = symmetric_relations
@@ -61,26 +124,26 @@ class CandidateExtractorUDF(UDF):
         # Make sure the candidate spaces are different so generators aren't expended!
         self.candidate_spaces = list(map(deepcopy, self.candidate_spaces))
 
-        # Preallocates internal data structures
-        self.child_context_sets = [None] * self.arity
-        for i in range(self.arity):
-            self.child_context_sets[i] = set()
-
         super(CandidateExtractorUDF, self).__init__(**kwargs)
 
-    def apply(self, context, clear, split, **kwargs):
-        # Generate TemporaryContexts that are children of the context using the candidate_space and filtered
+    def apply_batch(self, contexts, clear, split, **kwargs):
+        """Extract Candidates from a batch of Contexts"""
+        # Generate TemporaryContexts that are children of each context using the candidate_space and filtered
         # by the Matcher
-        for i in range(self.arity):
-            self.child_context_sets[i].clear()
-            for tc in self.matchers[i].apply(self.candidate_spaces[i].apply(context)):
-                tc.load_id_or_insert(self.session)
-                self.child_context_sets[i].add(tc)
-
-        # Generates and persists candidates
+        child_context_sets = [[set(self._match(i, context)) for i in range(self.arity)] for context in contexts]
+        candidates = [({'split': split}, args) for sets in child_context_sets for args in self._extract(sets)]
+        return self._candidates(candidates, [tc for sets in child_context_sets for tcs in sets for tc in tcs],
+                                check_for_existing=not clear)
+
+    def _match(self, i, context):
+        child_contexts = self.candidate_spaces[i].apply(context)
+        return child_contexts if self.matchers[i] is None else self.matchers[i].apply(child_contexts)
+
+    def _extract(self, child_context_sets):
+        """Returns the tuples of argument TemporaryContexts of the Candidates formed from the sets of child contexts of a context"""
+        candidates = []
         extracted = set()
-        candidate_args = {'split': split}
-        for args in product(*[enumerate(child_contexts) for child_contexts in self.child_context_sets]):
+        for args in product(*[enumerate(child_contexts) for child_contexts in child_context_sets]):
 
             # TODO: Make this work for higher-order relations
             if self.arity == 2:
@@ -99,21 +162,8 @@ class CandidateExtractorUDF(UDF):
                 # Keep track of extracted
                 extracted.add((a,b))
 
-            # Assemble candidate arguments
-            for i, arg_name in enumerate(self.candidate_class.__argnames__):
-                candidate_args[arg_name + '_id'] = args[i][1].id
-
-            # Checking for existence
-            if not clear:
-                q = select([self.candidate_class.id])
-                for key, value in candidate_args.items():
-                    q = q.where(getattr(self.candidate_class, key) == value)
-                candidate_id = self.session.execute(q).first()
-                if candidate_id is not None:
-                    continue
-
-            # Add Candidate to session
-            yield self.candidate_class(**candidate_args)
+            candidates.append(tuple(tc for i, tc in args))
+        return candidates
 
 
 class CandidateSpace(object):
@@ -164,13 +214,125 @@ class Ngrams(CandidateSpace):
                         ts1 = TemporarySpan(char_start=start, char_end=start + m.start(1) - 1, sentence=context)
                         if ts1 not in seen:
                             seen.add(ts1)
-                            yield ts
+                            yield ts1
                         ts2 = TemporarySpan(char_start=start + m.end(1), char_end=end, sentence=context)
                         if ts2 not in seen:
                             seen.add(ts2)
                             yield ts2
 
 
+class DictionaryNgrams(CandidateSpace):
+    """
+    Defines the space of candidates as the n-grams in a Sentence _x_ which match a phrase of a dictionary _d_,
+    i.e. a combined Ngrams candidate space and DictionaryMatch matcher, to use with no (or a pass-through)
+    Matcher in CandidateExtractor.
+
+    The dictionary is stored as a trie over the tokens of its phrases, which is walked from each token of the
+    sentence, so that only the matching spans are created, rather than all n-grams up to n_max. As with
+    longest_match_only in Matcher, a match which lies within another one is not returned.
+
+    As in Ngrams, a single word containing one of _split_tokens_ is also split in two at the first of them, and
+    each part matching a phrase of one token is returned, e.g. "carbidopa" in "levodopa/carbidopa".
+
+    NOTE: Phrases are matched token by token, so must be split by _tokenize_ the way the parser splits the
+    sentences (e.g. "Alzheimer 's" for CoreNLP), and are matched regardless of the whitespace between tokens.
+    A stemmer is applied to each token.
+
+    :param d: list of phrases
+    :param ignore_case: if True, phrases and tokens are lowercased before matching
+    :param attrib: the Sentence attribute whose tokens are matched
+    :param stemmer: optional 'porter', or an object having a stem() method
+    :param tokenize: function splitting a phrase into tokens; defaults to splitting on whitespace
+    :param longest_match_only: if False, returns all the matches, including those within another
+    :param split_tokens: the strings at which single tokens are split, as in Ngrams
+    """
+    def __init__(self, d, ignore_case=True, attrib='words', stemmer=None, tokenize=None, longest_match_only=True,
+                 split_tokens=('-', '/')):
+        CandidateSpace.__init__(self)
+        self.split_rgx          = r'('+r'|'.join(split_tokens)+r')' if split_tokens and len(split_tokens) > 0 else None
+        self.ignore_case        = ignore_case
+        self.attrib             = attrib
+        self.stemmer            = stemmer
+        self.longest_match_only = longest_match_only
+        if self.stemmer == 'porter':
+            from nltk.stem.porter import PorterStemmer
+            self.stemmer = PorterStemmer()
+
+        # Build the trie of the phrases: nested dicts of tokens, where the None key marks the end of a phrase
+        self.trie = {}
+        tokenize  = tokenize or (lambda phrase: phrase.split())
+        for phrase in d:
+            tokens = tokenize(phrase)
+            if len(tokens) == 0:
+                continue
+            node = self.trie
+            for token in tokens:
+                node = node.setdefault(self._normalize(token), {})
+            node[None] = True
+
+    def _normalize(self, token):
+        token = token.lower() if self.ignore_case else token
+        if self.stemmer is not None:
+            try:
+                token = self.stemmer.stem(token)
+            except UnicodeDecodeError:
+                pass
+        return token
+
+    def __deepcopy__(self, memo):
+        # The trie is not modified after construction, so can be shared
+        return self
+
+    def matches(self, tokens):
+        """Returns the (start, end) token index ranges, inclusive, of the phrases matching the tokens"""
+        tokens  = [self._normalize(token) for token in tokens]
+        max_end = -1
+        for i in range(len(tokens)):
+            node = self.trie
+            ends = []
+            for j in range(i, len(tokens)):
+                node = node.get(tokens[j])
+                if node is None:
+                    break
+                if None in node:
+                    ends.append(j)
+
+            # The longest match from a token lies within an earlier one iff it ends no later than them
+            if self.longest_match_only:
+                if len(ends) > 0 and ends[-1] > max_end:
+                    max_end = ends[-1]
+                    yield i, ends[-1]
+            else:
+                for j in reversed(ends):
+                    yield i, j
+
+    def split_matches(self, tokens):
+        """Returns the (index, start, end) character ranges, inclusive, of the parts of split tokens matching a phrase"""
+        if self.split_rgx is None:
+            return
+        for i, token in enumerate(tokens):
+            m = re.search(self.split_rgx, token) if len(token) > 1 else None
+            if m is None:
+                continue
+            for start, end in [(0, m.start(1) - 1), (m.end(1), len(token) - 1)]:
+                node = self.trie.get(self._normalize(token[start:end + 1]))
+                if start <= end and node is not None and None in node:
+                    yield i, start, end
+
+    def apply(self, context):
+        offsets = context.char_offsets
+        words   = context.words
+        covered = set()
+        for i, j in self.matches(getattr(context, self.attrib)):
+            covered.update(range(i, j + 1))
+            yield TemporarySpan(char_start=offsets[i], char_end=offsets[j] + len(words[j]) - 1, sentence=context)
+
+        # Parts of a token lie within any match covering it
+        for i, start, end in self.split_matches(words):
+            if not self.longest_match_only or i not in covered:
+                yield TemporarySpan(char_start=offsets[i] + start, char_end=offsets[i] + end, sentence=context)
+
+
 class PretaggedCandidateExtractor(UDFRunner):
     """UDFRunner for PretaggedCandidateExtractorUDF"""
     def __init__(self, candidate_class, entity_types, self_relations=False,
@@ -183,13 +345,13 @@ class PretaggedCandidateExtractor(UDFRunner):
         )
 
     def apply(self, xs, split=0, **kwargs):
-        super(PretaggedCandidateExtractor, self).apply(xs, split=split, **kwargs)
+        return super(PretaggedCandidateExtractor, self).apply(xs, split=split, **kwargs)
 
     def clear(self, session, split, **kwargs):
         session.query(Candidate).filter(Candidate.split == split).delete()
 
 
-class PretaggedCandidateExtractorUDF(UDF):
+class PretaggedCandidateExtractorUDF(CandidateExtractorUDFBase):
     """
     An extractor for Sentences with entities pre-tagged, and stored in the entity_types and entity_cids
     fields.
@@ -206,7 +368,39 @@ class PretaggedCandidateExtractorUDF(UDF):
         super(PretaggedCandidateExtractorUDF, self).__init__(**kwargs)
 
     def apply(self, context, clear, split, check_for_existing=True, **kwargs):
-        """Extract Candidates from a Context"""
+        return self.apply_batch([context], clear=clear, split=split, check_for_existing=check_for_existing, **kwargs)
+
+    def apply_batch(self, contexts, clear, split, check_for_existing=True, **kwargs):
+        """Extract Candidates from a batch of Contexts"""
+        candidates = []
+        spans      = []
+        for context in contexts:
+            entity_spans, entity_cids = self._entity_spans(context)
+            spans.extend(tc for et in sorted(entity_spans) for tc in entity_spans[et])
+            for args in product(*[enumerate(entity_spans[et]) for et in self.entity_types]):
+
+                # TODO: Make this work for higher-order relations
+                if self.arity == 2:
+                    ai, a = args[0]
+                    bi, b = args[1]
+
+                    # Check for self-joins, "nested" joins (joins from span to its subspan), and flipped duplicate
+                    # "symmetric" relations
+                    if not self.self_relations and a == b:
+                        continue
+                    elif not self.nested_relations and (a in b or b in a):
+                        continue
+                    elif not self.symmetric_relations and ai > bi:
+                        continue
+
+                values = {'split' : split}
+                for i, arg_name in enumerate(self.candidate_class.__argnames__):
+                    values[arg_name + '_cid'] = entity_cids[args[i][1]]
+                candidates.append((values, tuple(tc for i, tc in args)))
+        return self._candidates(candidates, spans, check_for_existing=check_for_existing)
+
+    def _entity_spans(self, context):
+        """Returns the entity Spans of a Sentence by entity type, and the map from each Span to its entity CID"""
         # For now, just handle Sentences
         if not isinstance(context, Sentence):
             raise NotImplementedError("%s is currently only implemented for Sentence contexts." % self.__name__)
@@ -235,43 +429,36 @@ class PretaggedCandidateExtractorUDF(UDF):
                         i        = idxs.pop(0)
                         char_end = context.char_offsets[i] + len(context.words[i]) - 1
 
-                    # Insert / load temporary span, also store map to entity CID
+                    # Create temporary span, also store map to entity CID
                     tc = TemporarySpan(char_start=char_start, char_end=char_end, sentence=context)
-                    tc.load_id_or_insert(self.session)
-                    entity_cids[tc.id] = cid
+                    entity_cids[tc] = cid
                     entity_spans[et].append(tc)
+        return entity_spans, entity_cids
 
-        # Generates and persists candidates
-        candidate_args = {'split' : split}
-        for args in product(*[enumerate(entity_spans[et]) for et in self.entity_types]):
-
-            # TODO: Make this work for higher-order relations
-            if self.arity == 2:
-                ai, a = args[0]
-                bi, b = args[1]
 
-                # Check for self-joins, "nested" joins (joins from span to its subspan), and flipped duplicate
-                # "symmetric" relations
-                if not self.self_relations and a == b:
-                    continue
-                elif not self.nested_relations and (a in b or b in a):
-                    continue
-                elif not self.symmetric_relations and ai > bi:
-                    continue
+def new_contexts(contexts):
+    """Returns the distinct TemporaryContexts in a list which are not in the database, in order"""
+    seen = set()
+    new  = []
+    for tc in contexts:
+        if tc.id is None and tc not in seen:
+            seen.add(tc)
+            new.append(tc)
+    return new
 
-            # Assemble candidate arguments
-            for i, arg_name in enumerate(self.candidate_class.__argnames__):
-                candidate_args[arg_name + '_id'] = args[i][1].id
-                candidate_args[arg_name + '_cid'] = entity_cids[args[i][1].id]
-
-            # Checking for existence
-            if check_for_existing:
-                q = select([self.candidate_class.id])
-                for key, value in candidate_args.items():
-                    q = q.where(getattr(self.candidate_class, key) == value)
-                candidate_id = self.session.execute(q).first()
-                if candidate_id is not None:
-                    continue
 
-            # Add Candidate to session
-            yield self.candidate_class(**candidate_args)
+def existing_candidates(session, candidate_class, candidate_args):
+    """
+    Given a list of dicts of the column values of Candidates, including the ids of all their arguments,
+    returns those of the Candidates which already exist in the database as tuples of their sorted items,
+    using one query per IN_QUERY_SIZE ids of the first argument rather than one per Candidate
+    """
+    if len(candidate_args) == 0:
+        return set()
+    columns  = sorted(candidate_args[0].keys())
+    first_id = getattr(candidate_class, candidate_class.__argnames__[0] + '_id')
+    existing = set()
+    for ids in batch_iter(sorted(set(args[first_id.key] for args in candidate_args)), IN_QUERY_SIZE):
+        q = select([getattr(candidate_class, column) for column in columns]).where(first_id.in_(ids))
+        existing.update(tuple(zip(columns, row)) for row in session.execute(q))
+    return existing
@@ -1,2 +1 @@
-from spacy import *
-
+from .spacy import *
@@ -1,4 +1,6 @@
+from __future__ import absolute_import
 from collections import defaultdict
+from multiprocessing import current_process
 from snorkel.models import construct_stable_id
 from snorkel.parser import Parser, ParserConnection
 
@@ -8,21 +10,35 @@ class SpaCy(Parser):
     spaCy
     https://spacy.io/
 
-    Minimal (buggy) implementation to show how alternate parsers can
-    be added to Snorkel.
+    Parses documents in batches with nlp.pipe, producing the same Sentence parts as StanfordCoreNLPServer,
+    without a JVM. Only the pipeline components needed for the requested annotators are run; without the
+    parser, sentences are split by spaCy's rule-based sentencizer, and the fields of the annotators not
+    run are left empty, as with RuleBasedParser: an empty string per token, and 0 (no parent) for
+    dep_parents.
     Models for each target language needs to be downloaded using the
     following command:
 
     python -m spacy download en
 
+    :param lang: name of the spaCy model to load
+    :param annotators: pipeline components to run, among 'tagger' (pos_tags), 'parser' (dep_parents,
+                       dep_labels and sentence splitting) and 'ner' (ner_tags)
+    :param batch_size: number of documents buffered by nlp.pipe
+    :param n_process: number of processes nlp.pipe parses in; as UDF processes cannot start processes of
+                      their own, this requires running CorpusParser with parallelism=1 or backend='thread'
     '''
-    def __init__(self,lang='en'):
+    def __init__(self, lang='en', annotators=['tagger', 'parser', 'ner'], batch_size=1000, n_process=1):
         try:
             import spacy
         except:
             raise Exception("spacy not installed. Use `pip install spacy`.")
         super(SpaCy, self).__init__(name="spaCy")
-        self.model = spacy.load('en')
+        self.annotators = annotators
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.model = spacy.load(lang, disable=[c for c in ['tagger', 'parser', 'ner'] if c not in annotators])
+        if 'parser' not in self.model.pipe_names:
+            self.model.add_pipe(self.model.create_pipe('sentencizer'))
 
     def connect(self):
         return ParserConnection(self)
@@ -34,26 +50,57 @@ class SpaCy(Parser):
         :param text:
         :return:
         '''
-        text = text.encode('utf-8', 'error')
-        text = text.decode('utf-8')
+        return self.parse_batch([(document, text)])
 
-        doc = self.model(text)
-        assert doc.is_parsed
+    def parse_batch(self, docs):
+        '''
+        Parse a list of (document, text) pairs with nlp.pipe
+        :param docs:
+        :return:
+        '''
+        # nlp.pipe would start child processes, which daemonic processes such as those of UDFRunner cannot have
+        if self.n_process != 1 and current_process().daemon:
+            raise ValueError("spaCy n_process > 1 cannot be used in a UDF process; run CorpusParser with "
+                             "parallelism=1 or backend='thread', or set n_process=1.")
+        docs = list(docs)
+        texts = (text.encode('utf-8', 'error').decode('utf-8') for _, text in docs)
+        kwargs = {'n_process': self.n_process} if self.n_process != 1 else {}
+        for (document, _), doc in zip(docs, self.model.pipe(texts, batch_size=self.batch_size, **kwargs)):
+            for parts in self._parse_doc(document, doc):
+                yield parts
 
+    def _parse_doc(self, document, doc):
+        '''
+        Convert the sentences of a spaCy Doc into Sentence parts
+        :param document:
+        :param doc:
+        :return:
+        '''
         position = 0
         for sent in doc.sents:
+            # CoreNLP does not return whitespace tokens
+            tokens = [token for token in sent if not token.is_space]
+            if len(tokens) == 0:
+                continue
+
+            # Dependency heads are 1-based indexes in the sentence, with 0 for the root
+            index = dict((token.i, i + 1) for i, token in enumerate(tokens))
+
             parts = defaultdict(list)
-            dep_order, dep_par, dep_lab = [], [], []
-            for token in sent:
-                parts['words'].append(str(token))
+            for token in tokens:
+                parts['words'].append(token.text)
                 parts['lemmas'].append(token.lemma_)
-                parts['pos_tags'].append(token.tag_)
-                parts['ner_tags'].append(token.ent_type_)
                 parts['char_offsets'].append(token.idx)
 
-                dep_par.append(token.head)
-                dep_lab.append(token.dep_)
-                #dep_order.append(deps['dependent'])
+                # Fields of the components not run are left empty, rather than NULL
+                parts['pos_tags'].append(token.tag_ if 'tagger' in self.annotators else u'')
+                parts['ner_tags'].append((token.ent_type_ or 'O') if 'ner' in self.annotators else u'')
+                if 'parser' in self.annotators:
+                    parts['dep_parents'].append(0 if token.head.i == token.i else index.get(token.head.i, 0))
+                    parts['dep_labels'].append(token.dep_)
+                else:
+                    parts['dep_parents'].append(0)
+                    parts['dep_labels'].append(u'')
 
             # Add null entity array (matching null for CoreNLP)
             parts['entity_cids'] = ['O' for _ in parts['words']]
@@ -61,26 +108,33 @@ class SpaCy(Parser):
 
             # Link the sentence to its parent document object
             parts['document'] = document
-            parts['text'] = sent.text
+
+            # As with CoreNLP, the whitespace between tokens is replaced by spaces
+            text = u''
+            for token in tokens:
+                text += u' ' * (token.idx - tokens[0].idx - len(text)) + token.text
+            parts['text'] = text
 
             # make char_offsets relative to start of sentence
             abs_sent_offset = parts['char_offsets'][0]
             parts['char_offsets'] = [
                 p - abs_sent_offset for p in parts['char_offsets']
             ]
-            parts['dep_parents'] = dep_par #sort_X_on_Y(dep_par, dep_order)
-            parts['dep_labels'] = dep_lab #sort_X_on_Y(dep_lab, dep_order)
             parts['position'] = position
 
-            # Add full dependency tree parse to document meta
-            # TODO
+            # store absolute sentence offsets
+            if document:
+                if 'abs_sent_offset' not in document.meta:
+                    document.meta['abs_sent_offset'] = {}
+                document.meta['abs_sent_offset'][position] = abs_sent_offset
 
             # Assign the stable id as document's stable id plus absolute
             # character offset
             abs_sent_offset_end = (abs_sent_offset + parts['char_offsets'][-1] +
                 len(parts['words'][-1]))
-            parts['stable_id'] = construct_stable_id(
-                document, 'sentence', abs_sent_offset, abs_sent_offset_end
-            )
+            if document:
+                parts['stable_id'] = construct_stable_id(
+                    document, 'sentence', abs_sent_offset, abs_sent_offset_end
+                )
             position += 1
             yield parts
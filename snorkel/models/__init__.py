@@ -26,14 +26,15 @@ For example, the correct way to define a new type of Context is:
     from snorkel.models.meta import SnorkelBase, snorkel_engine
     SnorkelBase.metadata.create_all(snorkel_engine)
 """
-from .meta import SnorkelBase, SnorkelSession, snorkel_engine, snorkel_postgres
+from .meta import SnorkelBase, SnorkelSession, snorkel_engine, snorkel_postgres, autocommits, insert_rows
 from .context import Context, Document, Sentence, TemporarySpan, Span
-from .context import construct_stable_id, split_stable_id
+from .context import construct_stable_id, split_stable_id, insert_contexts, load_context_ids
 from .candidate import Candidate, candidate_subclass, Marginal
 from .annotation import (
     Feature, FeatureKey, Label, LabelKey, GoldLabel, GoldLabelKey, StableLabel,
     Prediction, PredictionKey
 )
+from .checkpoint import Checkpoint
 
 # This call must be performed after all classes that extend SnorkelBase are
 # declared to ensure the storage schema is initialized
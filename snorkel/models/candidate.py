@@ -3,6 +3,7 @@ from sqlalchemy import (
 )
 from sqlalchemy.orm import relationship, backref
 from functools import partial
+import sys
 
 from .meta import SnorkelBase
 from ..models import snorkel_engine
@@ -152,6 +153,14 @@ def candidate_subclass(class_name, args, table_name=None, cardinality=None,
 
     # Create class
     C = type(class_name, (Candidate,), class_attribs)
+
+    # Make the class accessible as an attribute of this module, so that instances can be pickled,
+    # e.g. to send them between processes (without shadowing any of the module's own names)
+    module   = sys.modules[__name__]
+    existing = getattr(module, class_name, None)
+    if existing is None or (isinstance(existing, type) and issubclass(existing, Candidate)
+                            and existing is not Candidate):
+        setattr(module, class_name, C)
         
     # Create table in DB
     if not snorkel_engine.dialect.has_table(snorkel_engine, table_name):
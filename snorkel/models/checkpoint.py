@@ -0,0 +1,16 @@
+from sqlalchemy import Column, String
+
+from .meta import SnorkelBase
+
+
+class Checkpoint(SnorkelBase):
+    """
+    A progress ledger entry, recording that the input identified by key has been fully processed
+    (and its outputs committed) in the UDF run identified by name. Used to resume interrupted runs.
+    """
+    __tablename__ = 'checkpoint'
+    name          = Column(String, primary_key=True)
+    key           = Column(String, primary_key=True)
+
+    def __repr__(self):
+        return "%s (%s : %s)" % (self.__class__.__name__, self.name, self.key)
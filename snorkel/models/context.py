@@ -1,4 +1,4 @@
-from .meta import SnorkelBase, snorkel_postgres
+from .meta import IN_QUERY_SIZE, SnorkelBase, snorkel_postgres, insert_rows
 from sqlalchemy import Column, String, Integer, Text, ForeignKey, UniqueConstraint
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import relationship, backref
@@ -139,6 +139,13 @@ class TemporaryContext(object):
     def __init__(self):
         self.id = None
 
+    def load_id(self, session):
+        """Sets the id of the corresponding Context in the database, if there is one, without inserting"""
+        if self.id is None:
+            id = session.execute(select([Context.id]).where(Context.stable_id == self.get_stable_id())).first()
+            if id is not None:
+                self.id = id[0]
+
     def load_id_or_insert(self, session):
         if self.id is None:
             stable_id = self.get_stable_id()
@@ -153,6 +160,10 @@ class TemporaryContext(object):
             else:
                 self.id = id[0]
 
+    def promote(self):
+        """Returns a new Context object corresponding to this TemporaryContext, e.g. to add to a session"""
+        raise NotImplementedError()
+
     def __eq__(self, other):
         raise NotImplementedError()
 
@@ -225,6 +236,10 @@ class TemporarySpan(TemporaryContext):
                 'char_end'  : self.char_end,
                 'meta'      : self.meta}
 
+    def promote(self):
+        return Span(stable_id=self.get_stable_id(), sentence_id=self.sentence.id, char_start=self.char_start,
+                    char_end=self.char_end, meta=self.meta)
+
     def get_word_start(self):
         return self.char_to_word_index(self.char_start)
 
@@ -358,3 +373,46 @@ def construct_stable_id(parent_context, polymorphic_type, relative_char_offset_s
     start = parent_doc_char_start + relative_char_offset_start
     end   = parent_doc_char_start + relative_char_offset_end
     return "%s::%s:%s:%s" % (doc_id, polymorphic_type, start, end)
+
+
+def insert_contexts(session, rows):
+    """
+    Inserts rows (dicts of type and stable_id) into the context table with a single executemany INSERT,
+    assigning their ids in one block (see insert_rows), and sets the id of each row
+    """
+    insert_rows(session, Context.__table__, rows)
+
+
+def load_context_ids(session, contexts, insert=False, batch_size=IN_QUERY_SIZE):
+    """
+    Batched version of TemporaryContext.load_id and load_id_or_insert: sets the ids of a list of
+    TemporaryContexts from the database, looking them up by stable_id with one IN query per batch_size
+    contexts; if insert is True, those not in the database are then inserted, with one executemany
+    INSERT per table (see insert_contexts).
+    """
+    by_stable_id = {}
+    for tc in contexts:
+        if tc.id is None:
+            by_stable_id.setdefault(tc.get_stable_id(), []).append(tc)
+    stable_ids = list(by_stable_id.keys())
+    for i in range(0, len(stable_ids), batch_size):
+        q = select([Context.stable_id, Context.id]).where(Context.stable_id.in_(stable_ids[i:i+batch_size]))
+        for stable_id, id in session.execute(q):
+            for tc in by_stable_id.pop(stable_id):
+                tc.id = id
+    if not insert or len(by_stable_id) == 0:
+        return
+
+    # Insert the missing contexts, and then their rows in the tables of their types
+    missing = [tcs[0] for tcs in by_stable_id.values()]
+    rows = [{'type': tc._get_table_name(), 'stable_id': tc.get_stable_id()} for tc in missing]
+    insert_contexts(session, rows)
+    insert_args = {}
+    for tc, row in zip(missing, rows):
+        for other in by_stable_id[row['stable_id']]:
+            other.id = row['id']
+        args = tc._get_insert_args()
+        args['id'] = row['id']
+        insert_args.setdefault(tc._get_insert_query(), []).append(args)
+    for query, args in insert_args.items():
+        session.execute(text(query), args)
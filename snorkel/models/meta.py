@@ -3,6 +3,7 @@ from sqlalchemy import create_engine, event
 from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import text
 
 # Sets connection string
 snorkel_conn_string = os.environ['SNORKELDB'] if 'SNORKELDB' in os.environ and os.environ['SNORKELDB'] != '' \
@@ -13,6 +14,10 @@ snorkel_conn_string = os.environ['SNORKELDB'] if 'SNORKELDB' in os.environ and o
 snorkel_postgres = snorkel_conn_string.startswith('postgres')
 
 
+# Maximum number of values in the IN clause of a query, well below SQLite's default limit of 999 parameters
+IN_QUERY_SIZE = 500
+
+
 # Automatically turns on foreign key enforcement for SQLite
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
@@ -38,6 +43,40 @@ def new_sessionmaker():
     return SnorkelSession
 
 
+def autocommits(session):
+    """
+    Returns True if each statement the session executes is committed on its own: on Postgres (see
+    new_sessionmaker), unless its connection was given a transactional isolation level, e.g. by OutputWriter
+    """
+    if not snorkel_postgres:
+        return False
+    options = session.connection().get_execution_options()
+    return options.get('isolation_level', 'AUTOCOMMIT') == 'AUTOCOMMIT'
+
+
+def insert_rows(session, table, rows):
+    """
+    Inserts rows (dicts of column values) into a table with a single-column integer primary key, with a
+    single executemany INSERT, assigning their ids in one block, and sets the id of each row. On Postgres,
+    the ids are drawn from the table's sequence; otherwise (SQLite), the first row is inserted alone, which
+    takes the database write lock, so the following ids remain free until the transaction commits.
+    """
+    if len(rows) == 0:
+        return
+    pk = list(table.primary_key.columns)[0]
+    if snorkel_postgres:
+        q = text("SELECT nextval(pg_get_serial_sequence(:table, :column)) FROM generate_series(1, :n)")
+        for row, (id,) in zip(rows, session.execute(q, {'table': table.name, 'column': pk.name, 'n': len(rows)})):
+            row[pk.key] = id
+        session.execute(table.insert(), rows)
+    else:
+        first = session.execute(table.insert(), rows[0]).inserted_primary_key[0]
+        for i, row in enumerate(rows):
+            row[pk.key] = first + i
+        if len(rows) > 1:
+            session.execute(table.insert(), rows[1:])
+
+
 # We initialize the engine within the models module because models' schema can depend on
 # which data types are supported by the engine
 SnorkelSession = new_sessionmaker()
@@ -2,3 +2,4 @@ from .corenlp import *
 from .corpus_parser import *
 from .doc_preprocessors import *
 from .parser import *
+from .rule_based import *
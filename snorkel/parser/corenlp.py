@@ -1,14 +1,18 @@
 from __future__ import print_function
 import os
+import re
 import sys
 import json
 import signal
 import warnings
 
+from bisect import bisect_right
+
 from subprocess import Popen, PIPE
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
-from .parser import Parser, URLParserConnection
+from .parser import Parser, URLParserConnection, ConcurrentURLParserConnection, EndpointPool, ParseCache
 from ..models import construct_stable_id
 from ..utils import sort_X_on_Y
 
@@ -47,9 +51,21 @@ class StanfordCoreNLPServer(Parser):
     # CoreNLP changed some JSON element names across versions
     BLOCK_DEFS = {"3.6.0":"basic-dependencies", "3.7.0":"basicDependencies"}
 
+    # Separator between documents packed into one request; with the default ssplit options, two
+    # consecutive newlines always end a sentence
+    DOC_DELIM = u"\n\n"
+
+    # CoreNLP rejects requests over 100K characters
+    MAX_REQUEST_CHARS = 100000
+
+    # End of a sentence, for splitting long documents where they have no paragraph breaks
+    SENTENCE_END = re.compile(r'[.!?]["\')\]]*\s+', re.UNICODE)
+
     def __init__(self, annotators=['tokenize', 'ssplit', 'pos', 'lemma', 'depparse', 'ner'],
                  annotator_opts={}, tokenize_whitespace=False, split_newline=False,
-                 java_xmx='4g', port=12345, num_threads=1, verbose=False, version='3.6.0'):
+                 java_xmx='4g', port=12345, num_threads=1, verbose=False, version='3.6.0',
+                 max_in_flight=1, docs_per_request=1, num_servers=1, urls=None, request_timeout=None,
+                 cache_path=None, chunk_chars=50000, max_chars=50000):
         '''
         Create CoreNLP server instance.
         :param annotators:
@@ -61,6 +77,22 @@ class StanfordCoreNLPServer(Parser):
         :param num_threads:
         :param verbose:
         :param version:
+        :param max_in_flight: if > 1, each connection keeps up to this many requests in flight when parsing
+                              a batch of documents (e.g. CorpusParser.apply with batch_size > 1); see
+                              ConcurrentURLParserConnection. Should not exceed num_threads.
+        :param docs_per_request: number of documents packed into each of these requests
+        :param num_servers: number of server instances to launch, on ports port, port+1, ...; requests are
+                            routed across them by an EndpointPool
+        :param urls: base URLs (e.g. http://host:9000) of running servers to attach to, instead of launching
+        :param request_timeout: seconds to wait for a response before giving up on a request (or with several
+                                servers, retrying it on another)
+        :param cache_path: path of a ParseCache file, in which to store the parse of each document text (with
+                           this configuration), so that unchanged documents are not sent to the server again
+        :param chunk_chars: documents longer than this are split into chunks of at most this many characters, at
+                            paragraph or sentence breaks where possible, which are parsed separately (max_in_flight
+                            at a time) and merged back; must not exceed MAX_REQUEST_CHARS
+        :param max_chars: maximum number of characters of each request packing several documents together, see
+                          parse_batch; must not exceed MAX_REQUEST_CHARS
         '''
         super(StanfordCoreNLPServer,self).__init__(name="CoreNLP")
 
@@ -75,12 +107,31 @@ class StanfordCoreNLPServer(Parser):
         self.num_threads = num_threads
         self.verbose = verbose
         self.version = version
+        self.max_in_flight = max_in_flight
+        self.docs_per_request = docs_per_request
+        self.request_timeout = request_timeout
+        self.chunk_chars = min(chunk_chars, self.MAX_REQUEST_CHARS)
+        self.max_chars = min(max_chars, self.MAX_REQUEST_CHARS)
 
         # configure connection request options
         opts = self._conn_opts(annotators, annotator_opts, tokenize_whitespace, split_newline)
-        self.endpoint = 'http://127.0.0.1:%d/?%s' % (self.port, opts)
-
-        self._start_server()
+        self.ports = [self.port + i for i in range(num_servers)] if urls is None else []
+        urls = urls or ['http://127.0.0.1:%d' % port for port in self.ports]
+        self.endpoints = ['%s/?%s' % (url.rstrip('/'), opts) for url in urls]
+        self.endpoint = self.endpoints[0]
+        self.parse_cache = None
+        if cache_path is not None:
+            self.parse_cache = ParseCache(cache_path, config=self.version + opts)
+
+        # with several servers, requests are load balanced across them, skipping unresponsive ones
+        self.endpoint_pool = None
+        if len(urls) > 1:
+            self.endpoint_pool = EndpointPool(self.endpoints, [url.rstrip('/') + '/ping' for url in urls])
+
+        self.process_group = None
+        self.process_groups = []
+        if len(self.ports) > 0:
+            self._start_server()
 
         if self.verbose:
             self.summary()
@@ -92,13 +143,15 @@ class StanfordCoreNLPServer(Parser):
         :return:
         '''
         loc = os.path.join(os.environ['SNORKELHOME'], 'parser')
-        cmd = 'java -Xmx%s -cp "%s/*" edu.stanford.nlp.pipeline.StanfordCoreNLPServer --port %d --timeout %d --threads %d > /dev/null'
-        cmd = [cmd % (self.java_xmx, loc, self.port, self.timeout, self.num_threads)]
+        for port in self.ports:
+            cmd = 'java -Xmx%s -cp "%s/*" edu.stanford.nlp.pipeline.StanfordCoreNLPServer --port %d --timeout %d --threads %d > /dev/null'
+            cmd = [cmd % (self.java_xmx, loc, port, self.timeout, self.num_threads)]
 
-        # Setting shell=True returns only the pid of the screen, not any spawned child processes
-        # Killing child processes correctly requires using a process group
-        # http://stackoverflow.com/questions/4789837/how-to-terminate-a-python-subprocess-launched-with-shell-true
-        self.process_group = Popen(cmd, stdout=PIPE, shell=True, preexec_fn=os.setsid)
+            # Setting shell=True returns only the pid of the screen, not any spawned child processes
+            # Killing child processes correctly requires using a process group
+            # http://stackoverflow.com/questions/4789837/how-to-terminate-a-python-subprocess-launched-with-shell-true
+            self.process_groups.append(Popen(cmd, stdout=PIPE, shell=True, preexec_fn=os.setsid))
+        self.process_group = self.process_groups[0]
 
         if force_load:
             conn = self.connect()
@@ -161,10 +214,11 @@ class StanfordCoreNLPServer(Parser):
         :return:
         '''
         print("------------------------------------")
-        print(self.endpoint)
+        for endpoint in self.endpoints:
+            print(endpoint)
         print("version:", self.version)
-        print("shell pid:", self.process_group.pid)
-        print("port:", self.port)
+        print("shell pid:", ", ".join(str(pg.pid) for pg in self.process_groups))
+        print("port:", ", ".join(str(port) for port in self.ports))
         print("timeout:", self.timeout)
         print("threads:", self.num_threads)
         print("------------------------------------")
@@ -174,20 +228,25 @@ class StanfordCoreNLPServer(Parser):
         Return URL connection object for this server
         :return:
         '''
-        return URLParserConnection(self)
+        # with several servers, fail over to another quickly rather than retrying the connection
+        retries = 2 if self.endpoint_pool is not None else 20
+        if self.max_in_flight > 1:
+            return ConcurrentURLParserConnection(self, retries=retries, max_in_flight=self.max_in_flight,
+                                                 docs_per_request=self.docs_per_request)
+        return URLParserConnection(self, retries=retries)
 
     def close(self):
         '''
-        Kill the process group linked with this server.
+        Kill the process groups linked with this server.
         :return:
         '''
-        if self.verbose:
-            print("Killing CoreNLP server [{}]...".format(self.process_group.pid))
-        if self.process_group is not None:
+        for process_group in getattr(self, 'process_groups', []):
+            if self.verbose:
+                print("Killing CoreNLP server [{}]...".format(process_group.pid))
             try:
-                os.killpg(os.getpgid(self.process_group.pid), signal.SIGTERM)
+                os.killpg(os.getpgid(process_group.pid), signal.SIGTERM)
             except Exception as e:
-                sys.stderr.write('Could not kill CoreNLP server [{}] {}\n'.format(self.process_group.pid,e))
+                sys.stderr.write('Could not kill CoreNLP server [{}] {}\n'.format(process_group.pid,e))
 
     def parse(self, document, text, conn):
         '''
@@ -202,19 +261,201 @@ class StanfordCoreNLPServer(Parser):
             print(u"Warning, empty document {0} passed to CoreNLP".format(document.name if document else "?"), file=sys.stderr)
             return
 
+        for parts in self._parse_group([(document, text)], conn):
+            yield parts
+
+    def parse_batch(self, docs, conn, max_chars=None):
+        '''
+        Parse a list of (document, text) pairs, packing consecutive documents into single requests of up
+        to max_chars characters, separated by DOC_DELIM, to save the per-request overhead on short documents.
+        The sentences returned are split back to their documents using their character offsets; if any
+        sentence spans a document boundary (e.g. if ssplit options prevent breaking on newlines), the
+        documents of that request are parsed one by one instead.
+
+        :param docs: list of (document, text) pairs
+        :param conn: server URL+properties string
+        :param max_chars: maximum number of characters per request; defaults to that set on the server
+        :return:
+        '''
+        max_chars = min(max_chars or self.max_chars, self.MAX_REQUEST_CHARS)
+        group, n_chars = [], 0
+        for document, text in docs:
+            if len(text.strip()) == 0:
+                print(u"Warning, empty document {0} passed to CoreNLP".format(document.name if document else "?"), file=sys.stderr)
+                continue
+            if len(group) > 0 and n_chars + len(self.DOC_DELIM) + len(text) > max_chars:
+                for parts in self._parse_group(group, conn):
+                    yield parts
+                group, n_chars = [], 0
+            n_chars += len(text) + (len(self.DOC_DELIM) if len(group) > 0 else 0)
+            group.append((document, text))
+        for parts in self._parse_group(group, conn):
+            yield parts
+
+    def _parse_group(self, group, conn):
+        '''
+        Parse a list of (document, text) pairs with a single request, see parse_batch
+        :param group:
+        :param conn:
+        :return:
+        '''
+        for (document, _), result in zip(group, self._request_group([text for _, text in group], conn)):
+            if result is not None:
+                blocks, offset = result
+                for parts in self._parse_blocks(document, blocks, offset=offset):
+                    yield parts
+
+    def _request_group(self, texts, conn):
+        '''
+        Return the JSON sentence blocks of each text, with the offset of the text in the request they were
+        parsed in, or None if the response was malformed. Texts over chunk_chars characters are split into
+        chunks, see _request_chunked.
+        :param texts:
+        :param conn:
+        :return:
+        '''
+        if all(len(text) <= self.chunk_chars for text in texts):
+            return self._request_cached(texts, conn)
+        return [self._request_chunked(text, conn) if len(text) > self.chunk_chars
+                else self._request_cached([text], conn)[0] for text in texts]
+
+    def _request_chunked(self, text, conn):
+        '''
+        Split a long text into chunks, parse them separately, with up to max_in_flight requests at a time, and
+        merge their sentences back, with character offsets relative to the text
+        :param text:
+        :param conn:
+        :return:
+        '''
+        spans = self.split_text(text, self.chunk_chars)
+        request = lambda span: self._request_cached([text[span[0]:span[1]]], conn)[0]
+        if self.max_in_flight > 1:
+            pool = ThreadPool(min(self.max_in_flight, len(spans)))
+            try:
+                results = pool.map(request, spans)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [request(span) for span in spans]
+
+        merged = []
+        for (start, _), result in zip(spans, results):
+            if result is None:
+                return None
+            blocks, offset = result
+            for block in blocks:
+                for tok in block['tokens']:
+                    tok['characterOffsetBegin'] += start - offset
+                    tok['characterOffsetEnd'] += start - offset
+            merged.extend(blocks)
+        return merged, 0
+
+    def split_text(self, text, max_chars):
+        '''
+        Return the (start, end) offsets of consecutive chunks of text of at most max_chars characters, ending at
+        the last paragraph break (DOC_DELIM), else sentence end, else whitespace, within the limit
+        :param text:
+        :param max_chars:
+        :return:
+        '''
+        spans, start = [], 0
+        while len(text) - start > max_chars:
+            window = text[start:start + max_chars]
+            end = window.rfind(self.DOC_DELIM)
+            if end > 0:
+                end += len(self.DOC_DELIM)
+            else:
+                ends = [m.end() for m in self.SENTENCE_END.finditer(window)]
+                end = ends[-1] if ends else max(window.rfind(u' '), window.rfind(u'\n')) + 1
+            end = end if end > 0 else max_chars
+            spans.append((start, start + end))
+            start += end
+        spans.append((start, len(text)))
+        return spans
+
+    def _request_cached(self, texts, conn):
+        '''
+        Request the texts packed together, see _request_texts. Texts in the parse cache are not sent to the
+        server.
+        :param texts:
+        :param conn:
+        :return:
+        '''
+        if self.parse_cache is None:
+            return self._request_texts(texts, conn)
+        results = self.parse_cache.get_many(texts)
+        misses = [i for i, result in enumerate(results) if result is None]
+        for i, result in zip(misses, self._request_texts([texts[i] for i in misses], conn)):
+            results[i] = result
+        self.parse_cache.put_many([(texts[i], results[i]) for i in misses if results[i] is not None])
+        return results
+
+    def _request_texts(self, texts, conn):
+        '''
+        Send a list of texts to the server, packed into a single request, see _request_group
+        :param texts:
+        :param conn:
+        :return:
+        '''
+        if len(texts) == 0:
+            return []
+        elif len(texts) == 1:
+            blocks = self._request(texts[0], conn)
+            return [None if blocks is None else (blocks, 0)]
+
+        # Pack the texts, recording the offset at which each starts
+        starts, ends = [], []
+        for text in texts:
+            starts.append(ends[-1] + len(self.DOC_DELIM) if ends else 0)
+            ends.append(starts[-1] + len(text))
+        blocks = self._request(self.DOC_DELIM.join(texts), conn)
+        if blocks is None:
+            return [None] * len(texts)
+
+        # Assign each sentence to the text it starts in
+        text_blocks = [[] for _ in texts]
+        for block in blocks:
+            if len(block['tokens']) == 0:
+                continue
+            i = bisect_right(starts, block['tokens'][0]['characterOffsetBegin']) - 1
+            if block['tokens'][-1]['characterOffsetEnd'] > ends[i]:
+                warnings.warn(u"CoreNLP sentence spans documents; parsing them separately.", RuntimeWarning)
+                return [self._request_texts([text], conn)[0] for text in texts]
+            text_blocks[i].append(block)
+        return list(zip(text_blocks, starts))
+
+    def _request(self, text, conn):
+        '''
+        Post text to the server, returning the JSON sentence blocks of the response, or None if malformed
+        :param text:
+        :param conn:
+        :return:
+        '''
         text = text.encode('utf-8', 'error')
-        resp = conn.post(self.endpoint, data=text, allow_redirects=True)
+        if self.endpoint_pool is not None:
+            resp = self.endpoint_pool.post(conn, data=text, allow_redirects=True, timeout=self.request_timeout)
+        else:
+            resp = conn.post(self.endpoint, data=text, allow_redirects=True, timeout=self.request_timeout)
         content = resp.content.strip().decode('utf-8')
 
         # check for parsing error messages
         StanfordCoreNLPServer.validate_response(content)
 
         try:
-            blocks = json.loads(content, strict=False)['sentences']
+            return json.loads(content, strict=False)['sentences']
         except:
             warnings.warn(u"CoreNLP skipped a malformed sentence.", RuntimeWarning)
-            return
+            return None
 
+    def _parse_blocks(self, document, blocks, offset=0):
+        '''
+        Convert the JSON sentence blocks of a document into Sentence parts
+        :param document:
+        :param blocks:
+        :param offset: character offset of the document in the text sent to the server
+        :return:
+        '''
         position = 0
         for block in blocks:
             parts = defaultdict(list)
@@ -247,6 +488,7 @@ class StanfordCoreNLPServer(Parser):
             # make char_offsets relative to start of sentence
             abs_sent_offset = parts['char_offsets'][0]
             parts['char_offsets'] = [p - abs_sent_offset for p in parts['char_offsets']]
+            abs_sent_offset -= offset
             parts['dep_parents'] = sort_X_on_Y(dep_par, dep_order)
             parts['dep_labels'] = sort_X_on_Y(dep_lab, dep_order)
             parts['position'] = position
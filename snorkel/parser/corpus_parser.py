@@ -1,5 +1,7 @@
+from sqlalchemy import or_
+
 from .corenlp import StanfordCoreNLPServer
-from ..models import Candidate, Context, Sentence
+from ..models import Candidate, Context, Document, Sentence, insert_contexts
 from ..udf import UDF, UDFRunner
 
 
@@ -10,6 +12,16 @@ class CorpusParser(UDFRunner):
         super(CorpusParser, self).__init__(CorpusParserUDF,
                                            parser=self.parser,
                                            fn=fn)
+
+    def apply(self, xs, clear=True, incremental=False, **kwargs):
+        """
+        Parse the (Document, text) pairs xs into Sentences. If incremental is True, only Documents whose
+        stable_id and name are not yet in the database are parsed, and nothing is cleared, so that adding
+        documents to a corpus leaves the existing Sentences, Candidates and annotations in place.
+        """
+        return super(CorpusParser, self).apply(xs, clear=clear and not incremental, incremental=incremental,
+                                               **kwargs)
+
     def clear(self, session, **kwargs):
         session.query(Context).delete()
         # We cannot cascade up from child contexts to parent Candidates,
@@ -25,9 +37,73 @@ class CorpusParserUDF(UDF):
         self.req_handler = parser.connect()
         self.fn = fn
 
+    def shutdown(self):
+        # Stops e.g. the threads of a ConcurrentURLParserConnection
+        self.req_handler.close()
+
+    def get_input_key(self, x):
+        return x[0].stable_id
+
     def apply(self, x, **kwargs):
         """Given a Document object and its raw text, parse into Sentences"""
         doc, text = x
         for parts in self.req_handler.parse(doc, text):
             parts = self.fn(parts) if self.fn is not None else parts
             yield Sentence(**parts)
+
+    def apply_batch(self, xs, incremental=False, **kwargs):
+        """Given a list of Document objects and their raw texts, parse them together if the parser supports it"""
+        if incremental:
+            xs = self.skip_existing(xs)
+        if not hasattr(self.req_handler, 'parse_batch'):
+            for y in super(CorpusParserUDF, self).apply_batch(xs, **kwargs):
+                yield y
+            return
+        for parts in self.req_handler.parse_batch(xs):
+            parts = self.fn(parts) if self.fn is not None else parts
+            yield Sentence(**parts)
+
+    def skip_existing(self, xs):
+        """Returns the (Document, text) pairs in xs whose Document is not already in the database"""
+        if len(xs) == 0:
+            return xs
+        names      = [doc.name for doc, _ in xs]
+        stable_ids = [doc.stable_id for doc, _ in xs]
+        q = self.session.query(Document.name, Document.stable_id)\
+                        .filter(or_(Document.name.in_(names), Document.stable_id.in_(stable_ids)))
+        existing_names, existing_ids = set(), set()
+        for name, stable_id in q:
+            existing_names.add(name)
+            existing_ids.add(stable_id)
+        return [(doc, text) for doc, text in xs
+                if doc.name not in existing_names and doc.stable_id not in existing_ids]
+
+    def reduce_batch(self, ys, **kwargs):
+        """
+        Inserts a batch of parsed Sentences, and their new Documents, with executemany INSERTs, assigning
+        their context ids in one block (see insert_contexts), rather than adding them to the session one
+        by one. Is safe to run concurrently, so that each UDF process can write its own outputs.
+        """
+        docs, seen = [], set()
+        for sentence in ys:
+            doc = sentence.document
+            if doc is not None and doc.id is None and id(doc) not in seen:
+                seen.add(id(doc))
+                docs.append(doc)
+        rows = [{'type': 'document', 'stable_id': doc.stable_id} for doc in docs] + \
+               [{'type': 'sentence', 'stable_id': sentence.stable_id} for sentence in ys]
+        insert_contexts(self.session, rows)
+        for obj, row in zip(docs + list(ys), rows):
+            obj.id = row['id']
+
+        if len(docs) > 0:
+            self.session.execute(Document.__table__.insert(),
+                                 [{'id': doc.id, 'name': doc.name, 'meta': doc.meta} for doc in docs])
+        sentence_rows = []
+        for sentence in ys:
+            row = dict((c.name, getattr(sentence, c.name)) for c in Sentence.__table__.columns)
+            if sentence.document is not None:
+                row['document_id'] = sentence.document.id
+            sentence_rows.append(row)
+        if len(sentence_rows) > 0:
+            self.session.execute(Sentence.__table__.insert(), sentence_rows)
@@ -3,11 +3,25 @@ import glob
 import os
 import re
 import lxml.etree as et
+import lxml.html
+
+from collections import OrderedDict
+from itertools import islice
+from multiprocessing import Manager, Pool
+try:
+    from queue import Full
+except ImportError:
+    from Queue import Full
 
 from bs4 import BeautifulSoup
 
 from ..models import Document
 
+# Number of Documents sent back at a time by each process parsing a file in
+# DocPreprocessor.generate_parallel, and number of such chunks buffered per file
+PARALLEL_CHUNK_SIZE = 100
+PARALLEL_QUEUE_SIZE = 4
+
 
 class DocPreprocessor(object):
     """
@@ -17,13 +31,20 @@ class DocPreprocessor(object):
     :param path: filesystem path to file or directory to parse
     :param max_docs: the maximum number of Documents to produce,
         default=float('inf')
+    :param parallelism: if greater than 1, iterating parses this many files
+        at a time, in a pool of processes; see generate_parallel
+    :param ordered: when parsing in parallel, whether to yield the Documents
+        in the same order as generate(), default=True
 
     """
 
-    def __init__(self, path, encoding="utf-8", max_docs=float('inf')):
+    def __init__(self, path, encoding="utf-8", max_docs=float('inf'),
+        parallelism=1, ordered=True):
         self.path = path
         self.encoding = encoding
         self.max_docs = max_docs
+        self.parallelism = parallelism
+        self.ordered = ordered
 
     def generate(self):
         """
@@ -40,7 +61,69 @@ class DocPreprocessor(object):
                     if doc_count >= self.max_docs:
                         return
 
+    def generate_parallel(self, parallelism, ordered=True):
+        """
+        Parses a file or directory of files into a set of Document objects,
+        parsing up to parallelism files at a time in a pool of processes.
+
+        If ordered is False, the Documents of the files are yielded as soon as
+        they are parsed, rather than in file order. Each process sends the
+        Documents of its file back as it parses them, PARALLEL_CHUNK_SIZE at a
+        time, over a queue holding at most PARALLEL_QUEUE_SIZE such chunks per
+        file, so memory use stays bounded even for large (e.g. streamed XML)
+        files, and a slow consumer (e.g. CorpusParser) holds back the parsing.
+        Each file is parsed in a single process, so this is only faster for
+        inputs of several files.
+        """
+        doc_count = 0
+        manager = Manager()
+        stopped = manager.Event()
+        shared_queue = None
+        if not ordered:
+            shared_queue = manager.Queue(PARALLEL_QUEUE_SIZE * 2 * parallelism)
+        pool = Pool(parallelism)
+        files = enumerate(fp for fp in self._get_files(self.path)
+                          if self._can_read(os.path.basename(fp)))
+
+        # The async result, and the queue of the Documents, of each file
+        # being parsed, by file index
+        pending = OrderedDict()
+        try:
+            while True:
+                for i, fp in islice(files, 2 * parallelism - len(pending)):
+                    queue = shared_queue
+                    if queue is None:
+                        queue = manager.Queue(PARALLEL_QUEUE_SIZE)
+                    pending[i] = (pool.apply_async(_parse_file, (
+                        self, fp, os.path.basename(fp), i, queue, stopped
+                    )), queue)
+                if len(pending) == 0:
+                    return
+
+                # Without ordering, take the Documents of any file, else
+                # those of the oldest; None follows the last of a file
+                queue = shared_queue
+                if queue is None:
+                    queue = next(iter(pending.values()))[1]
+                i, docs = queue.get()
+                if docs is None:
+                    pending.pop(i)[0].get()
+                    continue
+                for doc, text in docs:
+                    yield doc, text
+                    doc_count += 1
+                    if doc_count >= self.max_docs:
+                        return
+        finally:
+            # The processes give up on files not fully sent back
+            stopped.set()
+            pool.close()
+            pool.join()
+            manager.shutdown()
+
     def __iter__(self):
+        if self.parallelism is not None and self.parallelism > 1:
+            return self.generate_parallel(self.parallelism, self.ordered)
         return self.generate()
 
     def get_stable_id(self, doc_id):
@@ -65,6 +148,37 @@ class DocPreprocessor(object):
             raise IOError("File or directory not found: %s" % (path,))
 
 
+def _parse_file(preprocessor, fp, file_name, i, queue, stopped):
+    """
+    Parse the file with index i in a process of
+    DocPreprocessor.generate_parallel, putting its (Document, text) pairs
+    into the queue in chunks, followed by None
+    """
+    try:
+        chunk = []
+        for doc in preprocessor.parse_file(fp, file_name):
+            chunk.append(doc)
+            if len(chunk) == PARALLEL_CHUNK_SIZE:
+                if not _put(queue, (i, chunk), stopped):
+                    return
+                chunk = []
+        if len(chunk) > 0:
+            _put(queue, (i, chunk), stopped)
+    finally:
+        _put(queue, (i, None), stopped)
+
+
+def _put(queue, x, stopped):
+    """Put x into the queue, giving up if stopped is set while it is full"""
+    while not stopped.is_set():
+        try:
+            queue.put(x, True, 1)
+            return True
+        except Full:
+            continue
+    return False
+
+
 class TSVDocPreprocessor(DocPreprocessor):
     """Simple parsing of TSV file with one (doc_name <tab> doc_text) per line"""
 
@@ -156,16 +270,22 @@ class TikaPreprocessor(DocPreprocessor):
             CSVPathsPreprocessor('input.csv', parser_factory=TikaPreprocessor)
         )
     """
-    # Tika is conditionally imported here
-    import tika
-    # automatically downloads tika jar and starts a JVM processif no REST API
-    # is configured in ENV
-    tika.initVM()  
-    from tika import parser as tk_parser
-    parser = tk_parser
+    # Tika is imported and initialized on first use, see get_parser
+    parser = None
+
+    @classmethod
+    def get_parser(cls):
+        if cls.parser is None:
+            import tika
+            # automatically downloads tika jar and starts a JVM processif no REST API
+            # is configured in ENV
+            tika.initVM()
+            from tika import parser as tk_parser
+            cls.parser = tk_parser
+        return cls.parser
 
     def parse_file(self, fp, file_name):
-        parsed = type(self).parser.from_file(fp)
+        parsed = self.get_parser().from_file(fp)
         txt = parsed['content']
         name = os.path.basename(fp).rsplit('.', 1)[0]
         stable_id = self.get_stable_id(name)
@@ -176,12 +296,28 @@ class TikaPreprocessor(DocPreprocessor):
 
 
 class HTMLDocPreprocessor(DocPreprocessor):
-    """Simple parsing of raw HTML files, assuming one document per file"""
+    """
+    Simple parsing of raw HTML files, assuming one document per file
+
+    :param use_lxml: if True, extract the text with an lxml.html XPath query
+        rather than BeautifulSoup, which is much faster. The text is the same,
+        except that HTML comments are excluded, and text nested at any depth
+        within head, script, style and title elements is excluded, rather
+        than only their direct text
+    """
+    TEXT_QUERY = '//text()[not(ancestor::style or ancestor::script or ancestor::head or ancestor::title)]'
+
+    def __init__(self, path, use_lxml=False, **kwargs):
+        super(HTMLDocPreprocessor, self).__init__(path, **kwargs)
+        self.use_lxml = use_lxml
 
     def parse_file(self, fp, file_name):
         with open(fp, 'rb') as f:
-            html = BeautifulSoup(f, 'lxml')
-            txt = filter(self._cleaner, html.findAll(text=True))
+            if self.use_lxml:
+                txt = lxml.html.parse(f).xpath(self.TEXT_QUERY)
+            else:
+                html = BeautifulSoup(f, 'lxml')
+                txt = filter(self._cleaner, html.findAll(text=True))
             txt = ' '.join(self._strip_special(s) for s in txt if s != '\n')
             name = os.path.basename(fp).rsplit('.', 1)[0]
             stable_id = self.get_stable_id(name)
@@ -201,7 +337,7 @@ class HTMLDocPreprocessor(DocPreprocessor):
         return True
 
     def _strip_special(self, s):
-        return (''.join(c for c in s if ord(c) < 128)).encode('ascii', 'ignore')
+        return s.encode('ascii', 'ignore')
 
 
 class XMLMultiDocPreprocessor(DocPreprocessor):
@@ -214,18 +350,27 @@ class XMLMultiDocPreprocessor(DocPreprocessor):
 
     **Note: Include the full document XML etree in the attribs dict with
     keep_xml_tree=True**
+
+    If the _document_ query selects elements by tag name anywhere in the
+    file (e.g. './/document'), the file is streamed with iterparse: each
+    document element is processed as soon as it has been read, and then
+    freed, so memory use does not grow with the size of the file. The _text_
+    and _id_ queries should then be relative to the document element. Other
+    _document_ queries are evaluated on the whole parsed file.
     """
 
     def __init__(self, path, doc='.//document', text='./text/text()',
-        id='./id/text()', keep_xml_tree=False):
-        DocPreprocessor.__init__(self, path)
+        id='./id/text()', keep_xml_tree=False, **kwargs):
+        DocPreprocessor.__init__(self, path, **kwargs)
         self.doc = doc
         self.text = text
         self.id = id
         self.keep_xml_tree = keep_xml_tree
 
     def parse_file(self, f, file_name):
-        for i, doc in enumerate(et.parse(f).xpath(self.doc)):
+        m = re.match(r'^\.?//([A-Za-z_][\w.-]*)$', self.doc)
+        docs = self._iter_docs(f, m.group(1)) if m else et.parse(f).xpath(self.doc)
+        for i, doc in enumerate(docs):
             doc_id = str(doc.xpath(self.id)[0])
             text = '\n'.join(
                 filter(lambda t: t is not None, doc.xpath(self.text))
@@ -236,5 +381,17 @@ class XMLMultiDocPreprocessor(DocPreprocessor):
             stable_id = self.get_stable_id(doc_id)
             yield Document(name=doc_id, stable_id=stable_id, meta=meta), text
 
+    def _iter_docs(self, f, tag):
+        """Stream the elements with the given tag (other than the root), freeing each once processed"""
+        for _, elem in et.iterparse(f, events=('end',), tag=tag, huge_tree=True):
+            if elem.getparent() is None:
+                continue
+            yield elem
+
+            # Free the element, and the (already processed) siblings before it
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
     def _can_read(self, fpath):
         return fpath.endswith('.xml')
@@ -1,5 +1,17 @@
+import hashlib
+import json
+import os
 import requests
+import sqlite3
 import sys
+import zlib
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from threading import Lock, local
+from time import sleep, time
+
+from ..models.meta import IN_QUERY_SIZE
 
 
 class Parser(object):
@@ -33,15 +45,39 @@ class ParserConnection(object):
         raise NotImplementedError()
 
     def parse(self, document, text):
-        yield self.parser.parse(document, text)
+        for parts in self.parser.parse(document, text):
+            yield parts
+
+    def parse_batch(self, docs):
+        '''
+        Return parse generator over a list of (document, text) pairs, using the parser's batched
+        parsing if supported
+        :param docs:
+        :return:
+        '''
+        if hasattr(self.parser, 'parse_batch'):
+            for parts in self.parser.parse_batch(docs):
+                yield parts
+            return
+        for document, text in docs:
+            for parts in self.parse(document, text):
+                yield parts
+
+    def close(self):
+        '''
+        Release any resources held by this connection, e.g. threads
+        :return:
+        '''
+        pass
 
 
 class URLParserConnection(ParserConnection):
     '''
     URL parser connection
     '''
-    def __init__(self, parser, retries=20):
+    def __init__(self, parser, retries=20, pool_maxsize=requests.adapters.DEFAULT_POOLSIZE):
         self.retries = retries
+        self.pool_maxsize = pool_maxsize
         self.parser = parser
         self.request = self._connection()
 
@@ -68,7 +104,7 @@ class URLParserConnection(ParserConnection):
         # See: http://stackoverflow.com/questions/30453152
         if sys.platform in ['darwin']:
             requests_session.trust_env = False
-        requests_session.mount('http://', HTTPAdapter(max_retries=retries))
+        requests_session.mount('http://', HTTPAdapter(max_retries=retries, pool_maxsize=self.pool_maxsize))
         return requests_session
 
     def parse(self, document, text):
@@ -79,3 +115,236 @@ class URLParserConnection(ParserConnection):
         :return:
         '''
         return self.parser.parse(document, text, self.request)
+
+    def parse_batch(self, docs):
+        '''
+        Return parse generator over a list of (document, text) pairs, using the parser's batched
+        requests if supported
+        :param docs:
+        :return:
+        '''
+        if hasattr(self.parser, 'parse_batch'):
+            return self.parser.parse_batch(docs, self.request)
+        return super(URLParserConnection, self).parse_batch(docs)
+
+    def close(self):
+        '''
+        Close the pooled HTTP connections of this connection
+        :return:
+        '''
+        self.request.close()
+
+
+class ConcurrentURLParserConnection(URLParserConnection):
+    '''
+    URL parser connection which, when parsing a batch of documents, keeps up to max_in_flight requests
+    in flight at once, over a pool of as many HTTP connections, so that a single process can keep all of
+    a server's threads busy. Each request is for docs_per_request documents, packed together if the parser
+    supports it. Parses are yielded in document order, and new requests are only sent as these are
+    consumed, so a slow consumer (e.g. writing Sentences to the database) holds back the requests.
+
+    Note: This uses a fixed-size pool of threads, rather than asyncio, which is not available on Python 2.
+    '''
+    def __init__(self, parser, retries=20, max_in_flight=8, docs_per_request=1):
+        self.max_in_flight = max_in_flight
+        self.docs_per_request = docs_per_request
+        self.pool = None
+        super(ConcurrentURLParserConnection, self).__init__(parser, retries=retries, pool_maxsize=max_in_flight)
+
+    def parse_batch(self, docs):
+        '''
+        Return parse generator over a list of (document, text) pairs, running up to max_in_flight requests
+        concurrently
+        :param docs:
+        :return:
+        '''
+        # The threads are started lazily, i.e. after any fork into a UDF process
+        if self.pool is None:
+            self.pool = ThreadPool(self.max_in_flight)
+        pending = deque()
+        chunk = []
+        for doc in docs:
+            chunk.append(doc)
+            if len(chunk) == self.docs_per_request:
+                pending.append(self.pool.apply_async(self._parse_chunk, (chunk,)))
+                chunk = []
+
+                # Wait for the oldest request before sending more than max_in_flight
+                while len(pending) >= self.max_in_flight:
+                    for parts in pending.popleft().get():
+                        yield parts
+        if len(chunk) > 0:
+            pending.append(self.pool.apply_async(self._parse_chunk, (chunk,)))
+        while len(pending) > 0:
+            for parts in pending.popleft().get():
+                yield parts
+
+    def _parse_chunk(self, docs):
+        return list(super(ConcurrentURLParserConnection, self).parse_batch(docs))
+
+    def close(self):
+        '''
+        Stop the threads of this connection, and close its HTTP connections
+        :return:
+        '''
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+        super(ConcurrentURLParserConnection, self).close()
+
+
+class EndpointPool(object):
+    '''
+    Routes requests across the endpoints of several parser server instances: each request is sent to the
+    available endpoint with the fewest requests outstanding (from this process), so that a slow instance
+    gets fewer of them. Endpoints which fail to respond are taken out of rotation for retry_secs, and then
+    health checked (with a GET of their health_url) before being used again; failed requests are retried
+    on another endpoint. If no endpoint is available for wait_secs, e.g. while the servers boot, gives up.
+    '''
+    def __init__(self, endpoints, health_urls, retry_secs=5, health_timeout=2, wait_secs=120):
+        self.endpoints = endpoints
+        self.health_urls = dict(zip(endpoints, health_urls))
+        self.retry_secs = retry_secs
+        self.health_timeout = health_timeout
+        self.wait_secs = wait_secs
+        self.outstanding = dict((e, 0) for e in endpoints)
+        self.last_sent = dict((e, 0.0) for e in endpoints)
+        self.down_until = dict((e, 0.0) for e in endpoints)
+        self.suspect = set()
+        self.lock = Lock()
+
+    def post(self, session, data, **kwargs):
+        '''
+        Post data to an endpoint using the requests session, retrying on another endpoint on failure
+        :param session:
+        :param data:
+        :return: response
+        '''
+        deadline = time() + self.wait_secs
+        while True:
+            endpoint = self._acquire(session)
+            if endpoint is None:
+                if time() > deadline:
+                    raise requests.exceptions.ConnectionError("No parser server available at: " + ", ".join(self.endpoints))
+                sleep(min(1, self.retry_secs))
+                continue
+            try:
+                return session.post(endpoint, data=data, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self._mark_down(endpoint)
+            finally:
+                self._release(endpoint)
+
+    def check_health(self, session, endpoint):
+        '''
+        Return True if the endpoint responds to a health check, else take it out of rotation
+        :param session:
+        :param endpoint:
+        :return:
+        '''
+        try:
+            healthy = session.get(self.health_urls[endpoint], timeout=self.health_timeout).status_code == 200
+        except requests.exceptions.RequestException:
+            healthy = False
+        if healthy:
+            with self.lock:
+                self.suspect.discard(endpoint)
+        else:
+            self._mark_down(endpoint)
+        return healthy
+
+    def _acquire(self, session):
+        while True:
+            with self.lock:
+                now = time()
+                up = [e for e in self.endpoints if self.down_until[e] <= now]
+                if len(up) == 0:
+                    return None
+
+                # Least outstanding requests; ties are broken round-robin
+                endpoint = min(up, key=lambda e: (self.outstanding[e], self.last_sent[e]))
+                self.outstanding[endpoint] += 1
+                self.last_sent[endpoint] = now
+                check = endpoint in self.suspect
+
+            # Endpoints coming back into rotation are health checked first
+            if not check or self.check_health(session, endpoint):
+                return endpoint
+            self._release(endpoint)
+
+    def _release(self, endpoint):
+        with self.lock:
+            self.outstanding[endpoint] -= 1
+
+    def _mark_down(self, endpoint):
+        with self.lock:
+            self.down_until[endpoint] = time() + self.retry_secs
+            self.suspect.add(endpoint)
+
+
+class ParseCache(object):
+    '''
+    On-disk cache of parser output, keyed by a hash of the parser configuration and the text parsed, so
+    that re-parsing unchanged documents (e.g. after a schema change or clear=True) replays the stored parses
+    instead of running the parser. Values are JSON-serializable objects, stored compressed in a SQLite file,
+    which can be shared by concurrent processes.
+
+    :param path: path of the SQLite file, created if needed
+    :param config: string identifying the parser configuration; changing it invalidates cached parses
+    '''
+    def __init__(self, path, config=''):
+        self.path = path
+        self.config = config
+        self.local = local()
+        self._connection().execute('CREATE TABLE IF NOT EXISTS parses (key TEXT PRIMARY KEY, value BLOB)')
+
+    def _connection(self):
+        # SQLite connections can be shared by neither threads nor forked processes
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.conn = sqlite3.connect(self.path, timeout=60)
+            self.local.conn.execute('PRAGMA journal_mode=WAL')
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    def key(self, text):
+        return hashlib.sha1((self.config + u'\0' + text).encode('utf-8')).hexdigest()
+
+    def get_many(self, texts):
+        '''
+        Return the cached values of a list of texts, with None for those not in the cache
+        :param texts:
+        :return:
+        '''
+        keys = [self.key(text) for text in texts]
+        values = {}
+        for i in range(0, len(keys), IN_QUERY_SIZE):
+            q = 'SELECT key, value FROM parses WHERE key IN (%s)' % ','.join('?' * len(keys[i:i+IN_QUERY_SIZE]))
+            for key, value in self._connection().execute(q, keys[i:i+IN_QUERY_SIZE]):
+                values[key] = json.loads(zlib.decompress(value).decode('utf-8'))
+        return [values.get(key) for key in keys]
+
+    def put_many(self, items):
+        '''
+        Store a list of (text, value) pairs in the cache
+        :param items:
+        :return:
+        '''
+        rows = [(self.key(text), sqlite3.Binary(zlib.compress(json.dumps(value).encode('utf-8'))))
+                for text, value in items]
+        if len(rows) > 0:
+            with self._connection() as conn:
+                conn.executemany('INSERT OR REPLACE INTO parses (key, value) VALUES (?, ?)', rows)
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM parses')
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM parses').fetchone()[0]
+
+    def __getstate__(self):
+        return {'path': self.path, 'config': self.config}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = local()
@@ -0,0 +1,131 @@
+import re
+
+from bisect import bisect_left
+from collections import defaultdict
+
+from .parser import Parser, ParserConnection
+from ..models import construct_stable_id
+
+
+class RuleBasedParser(Parser):
+    '''
+    In-process parser which only tokenizes and splits sentences, with regular expressions, for tasks
+    which only need words and char_offsets; orders of magnitude faster than running a full NLP pipeline.
+    Produces the same parts as StanfordCoreNLPServer, with the fields it does not annotate left empty: an
+    empty string per token for lemmas, pos_tags and dep_labels, and 0 (no parent) for dep_parents.
+
+    Sentences end at a '.', '!' or '?' token (plus any closing quotes or brackets) followed by whitespace,
+    and at blank lines, or at every newline if split_newline is True. Common abbreviations such as "Dr."
+    are kept as single tokens, and do not end sentences.
+
+    :param split_newline: if True, treat each line as a sentence
+    :param ner_patterns: optional list of (tag, regex) pairs; tokens lying within a match of a regex
+                         in the document text are given its tag as ner_tag, and other tokens 'O'. If
+                         None, ner_tags are left empty too.
+    :param abbreviations: words which, followed by a period, are tokenized as abbreviations
+    '''
+    ABBREVIATIONS = ['Mr', 'Mrs', 'Ms', 'Dr', 'Prof', 'Sr', 'Jr', 'St', 'Mt', 'vs', 'etc', 'al', 'Inc', 'Ltd',
+                     'Co', 'Corp', 'Jan', 'Feb', 'Mar', 'Apr', 'Jun', 'Jul', 'Aug', 'Sep', 'Sept', 'Oct', 'Nov',
+                     'Dec', 'No', 'Fig', 'Figs', 'Eq', 'approx', 'ca', 'cf']
+
+    # Acronyms (U.S.), words with inner hyphens, apostrophes or periods (e.g. 3.5), or single symbols
+    TOKEN = r"(?:\w\.){2,}|\w+(?:[-'.,]\w+)*|\S"
+
+    TERMINATORS = set(['.', '!', '?'])
+    CLOSERS = set(['"', "'", ')', ']', '}'])
+
+    def __init__(self, split_newline=False, ner_patterns=None, abbreviations=ABBREVIATIONS):
+        super(RuleBasedParser, self).__init__(name="RuleBased")
+        self.split_newline = split_newline
+        self.ner_patterns = [(tag, re.compile(rgx, re.UNICODE)) for tag, rgx in ner_patterns or []]
+        abbrvs = r'\b(?:%s)\.' % '|'.join(re.escape(a) for a in abbreviations) if abbreviations else None
+        self.token_rgx = re.compile('|'.join(filter(None, [abbrvs, self.TOKEN])), re.UNICODE)
+        self.break_rgx = re.compile(r'\n' if split_newline else r'\n\s*\n')
+
+    def connect(self):
+        return ParserConnection(self)
+
+    def close(self):
+        pass
+
+    def parse(self, document, text):
+        '''
+        Tokenize and split text into sentences, in the format of StanfordCoreNLPServer.parse
+        :param document:
+        :param text:
+        :return:
+        '''
+        tokens = list(self.token_rgx.finditer(text))
+        ner_tags = self._ner_tags(text, tokens) if self.ner_patterns else None
+
+        position = 0
+        for start, end in self._split(text, tokens):
+            parts = defaultdict(list)
+            parts['words'] = [m.group() for m in tokens[start:end]]
+            abs_sent_offset = tokens[start].start()
+            parts['char_offsets'] = [m.start() - abs_sent_offset for m in tokens[start:end]]
+            parts['text'] = text[abs_sent_offset:tokens[end - 1].end()]
+            parts['position'] = position
+            parts['ner_tags'] = ner_tags[start:end] if ner_tags is not None else [u'' for _ in parts['words']]
+
+            # Fields which are not annotated are left empty, rather than NULL
+            parts['lemmas'] = [u'' for _ in parts['words']]
+            parts['pos_tags'] = [u'' for _ in parts['words']]
+            parts['dep_parents'] = [0 for _ in parts['words']]
+            parts['dep_labels'] = [u'' for _ in parts['words']]
+
+            # Add null entity array (matching null for CoreNLP)
+            parts['entity_cids'] = ['O' for _ in parts['words']]
+            parts['entity_types'] = ['O' for _ in parts['words']]
+
+            # Link the sentence to its parent document object, and store absolute sentence offsets
+            parts['document'] = document if document else None
+            if document:
+                if 'abs_sent_offset' not in document.meta:
+                    document.meta['abs_sent_offset'] = {}
+                document.meta['abs_sent_offset'][position] = abs_sent_offset
+
+                # Assign the stable id as document's stable id plus absolute character offset
+                abs_sent_offset_end = tokens[end - 1].end()
+                parts['stable_id'] = construct_stable_id(document, 'sentence', abs_sent_offset,
+                                                         abs_sent_offset_end)
+            position += 1
+            yield parts
+
+    def _split(self, text, tokens):
+        '''
+        Return the (start, end) token index ranges of the sentences of text
+        :param text:
+        :param tokens: token regex matches
+        :return:
+        '''
+        start, ended = 0, False
+        for i in range(1, len(tokens)):
+            gap = text[tokens[i - 1].end():tokens[i].start()]
+            w = tokens[i - 1].group()
+            if w in self.TERMINATORS:
+                ended = True
+            elif w not in self.CLOSERS:
+                ended = False
+            if (ended and len(gap) > 0) or self.break_rgx.search(gap):
+                yield start, i
+                start, ended = i, False
+        if len(tokens) > 0:
+            yield start, len(tokens)
+
+    def _ner_tags(self, text, tokens):
+        '''
+        Tag the tokens lying within matches of the NER patterns; earlier patterns take precedence
+        :param text:
+        :param tokens: token regex matches
+        :return:
+        '''
+        starts = [m.start() for m in tokens]
+        tags = ['O'] * len(tokens)
+        for tag, rgx in reversed(self.ner_patterns):
+            for match in rgx.finditer(text):
+                i = bisect_left(starts, match.start())
+                while i < len(tokens) and tokens[i].end() <= match.end():
+                    tags[i] = tag
+                    i += 1
+        return tags
@@ -1,15 +1,43 @@
-from multiprocessing import Process, JoinableQueue
+from collections import OrderedDict
+from functools import partial
+import json
+from multiprocessing import Array, Process, JoinableQueue, Queue
+import pickle
+import sys
+from sqlalchemy import inspect
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.interfaces import MANYTOONE, ONETOMANY
+from sqlalchemy.sql import select
+from threading import Event, Thread
+from time import time
+import numpy as np
+import traceback
 try:
-    from queue import Empty
+    from queue import Empty, Full, Queue as ThreadQueue
 except:
-    from Queue import Empty
+    from Queue import Empty, Full, Queue as ThreadQueue
 
-from .models.meta import new_sessionmaker, snorkel_conn_string
-from .utils import ProgressBar
+from .models.checkpoint import Checkpoint
+from .models.meta import insert_rows, new_sessionmaker, snorkel_conn_string, snorkel_postgres
+from .utils import ProgressBar, batch_iter
 
 
 QUEUE_TIMEOUT = 3
 
+# Maximum number of input batches buffered in the in_queue when running in parallel
+MAX_QUEUE_SIZE = 1024
+
+# Maximum number of batches of outputs buffered in the out_queue, per UDF process, when these are sent
+# back to the parent process (in single-writer mode, or for a reduce step)
+MAX_OUT_QUEUE_SIZE = 16
+
+# Number of outputs written between commits, by default, by each writer (the UDF processes, or the parent
+# process in single-writer mode)
+WRITER_COMMIT_SIZE = 10000
+
+# Seconds between progress updates when running in parallel
+PROGRESS_INTERVAL = 1
+
 
 class UDFRunner(object):
     """Class to run UDFs in parallel using simple queue-based multiprocessing setup"""
@@ -18,18 +46,89 @@ class UDFRunner(object):
         self.udf_init_kwargs = udf_init_kwargs
         self.udfs            = []
 
-        if hasattr(self.udf_class, 'reduce'):
+        # Queues shared with the UDF processes, and the settings they were started with, if kept alive
+        self.in_queue      = None
+        self.out_queue     = None
+        self.done_queue    = None
+        self.pool_settings = None
+
+        # Counts of inputs processed, and times of last activity, of each UDF process in the current run
+        self.progress      = None
+        self.last_active   = None
+
+        # Counters and timings of the last run, see UDFStats
+        self.stats = None
+
+        if hasattr(self.udf_class, 'reduce') or hasattr(self.udf_class, 'reduce_batch'):
             self.reducer = self.udf_class(**self.udf_init_kwargs)
         else:
             self.reducer = None
 
-    def apply(self, xs, clear=True, parallelism=None, progress_bar=True, count=None, **kwargs):
+    def apply(self, xs, clear=True, parallelism=None, progress_bar=True, count=None,
+        batch_size=1, max_queue_size=MAX_QUEUE_SIZE, single_writer=None, flush_size=None, flush_secs=None,
+        checkpoint=None, keep_alive=False, backend='process', stats_path=None, progress_callback=None,
+        **kwargs):
         """
-        Apply the given UDF to the set of objects xs, either single or multi-threaded, 
+        Apply the given UDF to the set of objects xs, either single or multi-threaded,
         and optionally calling clear() first.
+
+        xs may be any iterable, including a generator or a lazily-paged query; when running
+        in parallel, it is consumed incrementally and at most max_queue_size batches are
+        buffered for the worker processes at any time.
+
+        Inputs are passed to UDF.apply_batch in lists of up to batch_size objects, which cuts
+        queue round trips, and lets UDFs which override apply_batch e.g. load a whole batch
+        from the database with a single query.
+
+        If single_writer is True, the UDF processes only compute, and send their outputs back over
+        a queue to the parent process, which is then the only one writing to the database. This is
+        required for running in parallel with SQLite, and is the default there. At most MAX_OUT_QUEUE_SIZE
+        batches of outputs per process are buffered for the parent, so that memory stays bounded if it falls
+        behind. The same objects are written in either mode.
+
+        Outputs are buffered and written with bulk INSERTs (or passed to the reduce step); each writer
+        flushes and commits every flush_size outputs and / or every flush_secs seconds, so that memory
+        use stays bounded and partial progress is durable. If neither is set, flush_size defaults to
+        WRITER_COMMIT_SIZE.
+
+        If checkpoint is given, it names a progress ledger in the database, in which the key of each
+        input (see UDF.get_input_key) is recorded in the same transaction as its outputs, at each flush;
+        also on Postgres, where statements are otherwise autocommitted. If the run is interrupted, calling
+        apply again with the same checkpoint resumes it: clear() is skipped, as are the inputs already
+        recorded. The ledger is deleted once the run completes. Note that anything UDF.apply writes itself
+        (e.g. the Spans inserted by CandidateExtractor) is committed separately, so is looked up again
+        rather than re-inserted on resume; and that outputs are only durable once flushed, so checkpoint
+        should be used with flush_size and / or flush_secs.
+
+        If keep_alive is True, the UDF processes are not shut down after running in parallel, and are
+        reused by subsequent calls with the same parallelism, single_writer and max_queue_size, so that
+        process startup, database engine creation and any warm-up in the UDF's __init__ are only paid
+        once. In this case, the apply kwargs are pickled and sent to the processes for each call, and
+        any which cannot be (e.g. a Query bound to a session) are not passed to UDF.apply. Call close()
+        to shut the processes down.
+
+        With backend='thread', the UDFs are run in parallel on threads of this process instead, each
+        with its own database session (and e.g. its own parser connection), which gives concurrency for
+        I/O-bound UDFs such as CorpusParserUDF without the memory and startup cost of processes. Note
+        that the inputs are then shared with the threads rather than copied, so should not be ORM objects
+        which may need to be loaded lazily through the session they are bound to.
+
+        When running in parallel, the UDF processes count the inputs they have processed in shared memory,
+        and progress (with the rate, ETA and liveness of each process) is shown every PROGRESS_INTERVAL
+        seconds if progress_bar is True, and passed to progress_callback as a UDFProgress, if set; e.g.
+        to detect stalled processes. Note that progress_callback is called from a separate thread.
+
+        Returns a UDFStats object with counters and timings of the run, per worker and overall, which
+        is also kept as self.stats; if stats_path is set, these are also appended to that file as JSON
+        lines.
         """
+        # If resuming from a checkpoint, keep the outputs already written
+        resume = checkpoint is not None and self.has_checkpoint(checkpoint)
+        if resume:
+            print("Resuming from checkpoint %s..." % checkpoint)
+
         # Clear everything downstream of this UDF if requested
-        if clear:
+        if clear and not resume:
             print("Clearing existing...")
             SnorkelSession = new_sessionmaker()
             session = SnorkelSession()
@@ -39,17 +138,66 @@ class UDFRunner(object):
 
         # Execute the UDF
         print("Running UDF...")
+        start = time()
         if parallelism is None or parallelism < 2:
-            self.apply_st(xs, progress_bar, clear=clear, count=count, **kwargs)
+            completed, stats = self.apply_st(xs, progress_bar, clear=clear, count=count, batch_size=batch_size,
+                                      flush_size=flush_size, flush_secs=flush_secs, checkpoint=checkpoint,
+                                      **kwargs)
         else:
-            self.apply_mt(xs, parallelism, clear=clear, **kwargs)
+            if single_writer is None:
+                single_writer = snorkel_conn_string.startswith('sqlite')
+            completed, stats = self.apply_mt(xs, parallelism, batch_size=batch_size, max_queue_size=max_queue_size,
+                                      single_writer=single_writer, flush_size=flush_size, flush_secs=flush_secs,
+                                      checkpoint=checkpoint, keep_alive=keep_alive, backend=backend,
+                                      progress_bar=progress_bar, count=count,
+                                      progress_callback=progress_callback, clear=clear, **kwargs)
+
+        # Once all inputs have been processed, the progress ledger is no longer needed
+        if checkpoint is not None:
+            if completed:
+                self.clear_checkpoint(checkpoint)
+            else:
+                print("UDF did not complete; run again to resume from checkpoint %s." % checkpoint)
+
+        # Record the counters and timings of the run
+        self.stats = UDFStats(self.udf_class.__name__, stats, time() - start, completed)
+        if stats_path is not None:
+            self.stats.write_json(stats_path)
+        return self.stats
 
     def clear(self, session, **kwargs):
         raise NotImplementedError()
 
-    def apply_st(self, xs, progress_bar, count, **kwargs):
+    def has_checkpoint(self, checkpoint):
+        """Returns True if any inputs are recorded as completed in the named progress ledger"""
+        SnorkelSession = new_sessionmaker()
+        session = SnorkelSession()
+        exists  = session.query(Checkpoint.key).filter(Checkpoint.name == checkpoint).first() is not None
+        session.close()
+        return exists
+
+    def clear_checkpoint(self, checkpoint):
+        """Deletes the named progress ledger"""
+        SnorkelSession = new_sessionmaker()
+        session = SnorkelSession()
+        session.query(Checkpoint).filter(Checkpoint.name == checkpoint).delete()
+        session.commit()
+        session.close()
+
+    def apply_st(self, xs, progress_bar, count, batch_size=1, flush_size=None, flush_secs=None, checkpoint=None,
+        **kwargs):
         """Run the UDF single-threaded, optionally with progress bar"""
         udf = self.udf_class(**self.udf_init_kwargs)
+        udf.checkpoint = checkpoint
+        stats = WorkerStats('main')
+
+        # If UDF has a reduce step, this will take care of the insert; else outputs are buffered and bulk inserted
+        flush_size = default_flush_size(flush_size, flush_secs)
+        if self.reducer is not None:
+            writer = OutputWriter(self.reducer.session, flush_size=flush_size, flush_secs=flush_secs,
+                                  reducer=self.reducer, reduce_kwargs=kwargs, checkpoint=checkpoint)
+        else:
+            writer = OutputWriter(udf.session, flush_size=flush_size, flush_secs=flush_secs, checkpoint=checkpoint)
 
         # Set up ProgressBar if possible
         pb = None
@@ -58,84 +206,667 @@ class UDFRunner(object):
             pb = ProgressBar(n)
         
         # Run single-thread
-        for i, x in enumerate(xs):
+        i = 0
+        for batch in batch_iter(xs, batch_size):
             if pb:
-                pb.bar(i)
-
-            # Apply UDF and add results to the session
-            for y in udf.apply(x, **kwargs):
-                
-                # Uf UDF has a reduce step, this will take care of the insert; else add to session
-                if hasattr(self.udf_class, 'reduce'):
-                    udf.reduce(y, **kwargs)
-                else:
-                    udf.session.add(y)
-
-        # Commit session and close progress bar if applicable
-        udf.session.commit()
+                for j in range(i, i + len(batch)):
+                    pb.bar(j)
+            i += len(batch)
+
+            # Apply UDF and write results
+            keys, ys = udf.process_batch(batch, stats, **kwargs)
+            for y in ys:
+                writer.write(y)
+            writer.done(keys)
+
+        # Write and commit remaining outputs, and close progress bar if applicable
+        writer.flush()
+        udf.shutdown()
+        stats.db_secs += writer.db_secs
         if pb:
             pb.bar(n)
             pb.close()
-        
-    def apply_mt(self, xs, parallelism, **kwargs):
-        """Run the UDF multi-threaded using python multiprocessing"""
-        if snorkel_conn_string.startswith('sqlite'):
-            raise ValueError('Multiprocessing with SQLite is not supported. Please use a different database backend,'
-                             ' such as PostgreSQL.')
-
-        # Fill a JoinableQueue with input objects
-        in_queue = JoinableQueue()
-        for x in xs:
-            in_queue.put(x)
+        return True, [stats]
 
-        # If the UDF has a reduce step, we collect the output of apply in a Queue
-        out_queue = None
-        if hasattr(self.udf_class, 'reduce'):
-            out_queue = JoinableQueue()
+    def apply_mt(self, xs, parallelism, batch_size=1, max_queue_size=MAX_QUEUE_SIZE, single_writer=False,
+        flush_size=None, flush_secs=None, checkpoint=None, keep_alive=False, backend='process',
+        progress_bar=False, count=None, progress_callback=None, **kwargs):
+        """Run the UDF multi-threaded using python multiprocessing, or threads if backend='thread'"""
+        if backend not in ('process', 'thread'):
+            raise ValueError("Unknown backend %s; must be 'process' or 'thread'." % backend)
+        if snorkel_conn_string.startswith('sqlite') and not single_writer:
+            raise ValueError('Multiprocessing with SQLite is only supported with single_writer=True. Otherwise,'
+                             ' please use a different database backend, such as PostgreSQL.')
+        settings = {
+            'single_writer' : single_writer,
+            'flush_size'    : flush_size,
+            'flush_secs'    : flush_secs,
+            'checkpoint'    : checkpoint
+        }
 
-        # Start UDF Processes
-        for i in range(parallelism):
-            udf              = self.udf_class(in_queue=in_queue, out_queue=out_queue, **self.udf_init_kwargs)
-            udf.apply_kwargs = kwargs
-            self.udfs.append(udf)
+        # If the UDF has a reduce step, or in single-writer mode, we collect the output of apply in a
+        # Queue, one list per batch; unless the reduce step can be run on batches by each UDF process
+        send_outputs = single_writer or (self.reducer is not None and not hasattr(self.reducer, 'reduce_batch'))
 
-        # Start the UDF processes, and then join on their completion
-        for udf in self.udfs:
-            udf.start()
+        # Reuse the UDF processes kept alive from the previous call if they were started the same way;
+        # they are sent the settings for this run over their control queues
+        if keep_alive:
+            pool_settings = (parallelism, send_outputs, max_queue_size, backend)
+            if pool_settings != self.pool_settings or not all([udf.is_alive() for udf in self.udfs]):
+                self.close()
+                self._start_udfs(parallelism, send_outputs, max_queue_size, backend, pooled=True)
+                self.pool_settings = pool_settings
+            settings['apply_kwargs'] = picklable_items(kwargs)
+            self._reset_progress()
+            for udf in self.udfs:
+                udf.ctl_queue.put(settings)
 
-        # If there is a reduce step, do now on this thread
-        if hasattr(self.udf_class, 'reduce'):
-            while any([udf.is_alive() for udf in self.udfs]):
-                while True:
-                    try:
-                        y = out_queue.get(True, QUEUE_TIMEOUT)
-                        self.reducer.reduce(y, **kwargs)
-                        out_queue.task_done()
-                    except Empty:
-                        break
-                self.reducer.session.commit()
-            self.reducer.session.close()
-
-        # Otherwise just join on the UDF.apply actions
+        # Otherwise start new UDF processes, passing the settings in before forking
         else:
+            self.close()
+            self._start_udfs(parallelism, send_outputs, max_queue_size, backend, pooled=False,
+                             apply_kwargs=kwargs, **settings)
+
+        # Batches of input objects are streamed into a bounded JoinableQueue by a producer thread, so that
+        # the UDF processes start on the first batch right away and memory does not grow with len(xs)
+        feeder = QueueFeeder(batch_iter(xs, batch_size), self.in_queue, n_consumers=parallelism)
+        feeder.start()
+
+        # Report progress from a separate thread, as this one may be blocked e.g. writing outputs
+        monitor = None
+        if progress_bar or progress_callback is not None:
+            n = count if count is not None else len(xs) if hasattr(xs, '__len__') else None
+            monitor = ProgressMonitor(self, n, show=progress_bar, callback=progress_callback)
+            monitor.start()
+
+        # If there is a reduce step, or in single-writer mode, write the outputs now on this thread
+        stats = []
+        if self.out_queue is not None:
+            stats.append(self._write_outputs(self.out_queue, flush_size=flush_size, flush_secs=flush_secs,
+                                             checkpoint=checkpoint, **kwargs))
+
+        # Wait for the UDF processes to finish this run; if not kept alive, also join on their completion
+        completed, udf_stats = self._wait_for_run()
+        stats.extend(udf_stats)
+        if not keep_alive:
             for i, udf in enumerate(self.udfs):
                 udf.join()
+            completed = completed and all([udf.exitcode == 0 for udf in self.udfs])
+
+        # Stop the producer thread in case the UDF processes exited before consuming all inputs
+        feeder.stop()
+        feeder.join()
+        if monitor is not None:
+            monitor.stop()
+            monitor.join()
+
+        # Terminate the processes, unless they are kept alive (and all of them still are)
+        if not keep_alive or not completed:
+            self.close()
+        if feeder.error is not None:
+            raise feeder.error
+        return completed, stats
+
+    def _start_udfs(self, parallelism, send_outputs, max_queue_size, backend='process', pooled=False,
+        **settings):
+        """Start parallelism UDF processes (or threads), and the queues shared with them"""
+        if backend == 'thread':
+            JQueue, CtlQueue = ThreadQueue, ThreadQueue
+        else:
+            JQueue, CtlQueue = JoinableQueue, Queue
+        self.in_queue   = JQueue(maxsize=max_queue_size)
+        self.out_queue  = JQueue(maxsize=parallelism * MAX_OUT_QUEUE_SIZE) if send_outputs else None
+        self.done_queue = CtlQueue()
+
+        # Progress counters in shared memory, each written only by its UDF process
+        self.progress    = Array('l', parallelism, lock=False)
+        self.last_active = Array('d', parallelism, lock=False)
+        self._reset_progress()
+        for i in range(parallelism):
+            udf = self.udf_class(in_queue=self.in_queue, out_queue=self.out_queue,
+                                 ctl_queue=CtlQueue() if pooled else None, done_queue=self.done_queue,
+                                 **self.udf_init_kwargs)
+            udf.worker_id   = i
+            udf.progress    = self.progress
+            udf.last_active = self.last_active
+            for name, value in settings.items():
+                setattr(udf, name, value)
+            self.udfs.append(UDFThread(udf) if backend == 'thread' else udf)
+        for udf in self.udfs:
+            udf.start()
+
+    def _reset_progress(self):
+        for i in range(len(self.progress)):
+            self.progress[i]    = 0
+            self.last_active[i] = time()
+
+    def _wait_for_run(self):
+        """
+        Wait for each of the UDF processes to signal that it has finished the current run, sending its
+        WorkerStats; returns whether all of them did (rather than dying first), and the stats
+        """
+        stats = {}
+        while len(stats) < len(self.udfs):
+            try:
+                worker_id, worker_stats = self.done_queue.get(True, QUEUE_TIMEOUT)
+                stats[worker_id] = worker_stats
+            except Empty:
+                if any([not udf.is_alive() and i not in stats for i, udf in enumerate(self.udfs)]):
+                    return False, [stats[i] for i in sorted(stats)]
+        return True, [stats[i] for i in sorted(stats)]
 
-        # Terminate and flush the processes
+    def close(self):
+        """Shut down the UDF processes, e.g. if kept alive by apply(..., keep_alive=True)"""
+        for udf in self.udfs:
+            if udf.ctl_queue is not None and udf.is_alive():
+                udf.ctl_queue.put(None)
         for udf in self.udfs:
+            if udf.ctl_queue is not None:
+                udf.join(QUEUE_TIMEOUT)
             udf.terminate()
-        self.udfs = []
+        self.udfs          = []
+        self.pool_settings = None
+
+    def _write_outputs(self, out_queue, flush_size=None, flush_secs=None, checkpoint=None, **kwargs):
+        """
+        Consume the (keys, outputs) of each batch sent back by the UDF processes until each has sent QueueClosed,
+        either passing them to the reduce step, or else writing them, and committing per the flush
+        policy (by default, every WRITER_COMMIT_SIZE outputs) as well as whenever the queue runs empty
+        """
+        if self.reducer is not None:
+            session = self.reducer.session
+        else:
+            SnorkelSession = new_sessionmaker()
+            session        = SnorkelSession()
+        flush_size = default_flush_size(flush_size, flush_secs)
+        writer     = OutputWriter(session, flush_size=flush_size, flush_secs=flush_secs, reducer=self.reducer,
+                                  reduce_kwargs=kwargs, checkpoint=checkpoint)
+        stats      = WorkerStats('writer')
+        n_closed   = 0
+        while n_closed < len(self.udfs):
+            try:
+                t   = time()
+                out = out_queue.get(True, QUEUE_TIMEOUT)
+                stats.wait_secs += time() - t
+            except Empty:
+                stats.wait_secs += time() - t
+                writer.flush()
+
+                # Stop if the UDF processes died without closing the queue, e.g. on an exception; processes
+                # kept alive do not exit after the run, so stop if any of these died
+                if not any([udf.is_alive() for udf in self.udfs]) or \
+                   (self.pool_settings is not None and not all([udf.is_alive() for udf in self.udfs])):
+                    break
+                continue
+            if isinstance(out, QueueClosed):
+                n_closed += 1
+            else:
+                keys, ys = out
+                stats.sample_backlog(out_queue)
+                for y in ys:
+                    writer.write(y)
+                writer.done(keys)
+            out_queue.task_done()
+        writer.flush()
+        session.close()
+        stats.db_secs = writer.db_secs
+        return stats
+
+
+class OutputWriter(object):
+    """
+    Writes the outputs of a UDF to the database: either by passing each to the reduce step of reducer
+    (a UDF), or else by buffering them and inserting them in bulk; if the reducer has a reduce_batch
+    step, the buffered outputs are passed to this instead. At the end of each batch of inputs, flushes and commits
+    if flush_size outputs have been written and / or flush_secs seconds have passed since the last flush,
+    if set; and whenever flush() is called. If checkpoint is set, the keys of the inputs are recorded in
+    the same transaction as their outputs, which are then also buffered for the reduce step.
+    """
+    def __init__(self, session, flush_size=None, flush_secs=None, reducer=None, reduce_kwargs=None,
+        checkpoint=None):
+        self.session      = session
+        self.flush_size   = flush_size
+        self.flush_secs   = flush_secs
+        self.reduce       = None
+        self.reduce_batch = None
+        if hasattr(reducer, 'reduce_batch'):
+            self.reduce_batch = partial(reducer.reduce_batch, **(reduce_kwargs or {}))
+        elif reducer is not None:
+            self.reduce = partial(reducer.reduce, **(reduce_kwargs or {}))
+        self.checkpoint = checkpoint
+        self.buffer     = []
+        self.keys       = []
+        self.n_pending  = 0
+        self.last_flush = time()
+        self.db_secs    = 0.0
+
+    def write(self, y):
+        if self.reduce is not None and self.checkpoint is None:
+            t = time()
+            self.reduce(y)
+            self.db_secs += time() - t
+        else:
+            self.buffer.append(y)
+        self.n_pending += 1
+
+    def done(self, keys=None):
+        """Marks the end of a batch of inputs, identified by keys if recording them to a checkpoint"""
+        if keys is not None:
+            self.keys.extend(keys)
+        if (self.flush_size is not None and self.n_pending >= self.flush_size) or \
+           (self.flush_secs is not None and time() - self.last_flush >= self.flush_secs):
+            self.flush()
+
+    def flush(self):
+        t = time()
+        if self.checkpoint is not None:
+            self._begin()
+        if self.reduce_batch is not None:
+            self.reduce_batch(self.buffer)
+        elif self.reduce is not None:
+            for y in self.buffer:
+                self.reduce(y)
+        else:
+            bulk_insert(self.session, self.buffer)
+
+        # Make sure the outputs are written before recording their inputs as completed
+        if self.checkpoint is not None and len(self.keys) > 0:
+            self.session.flush()
+            self.session.execute(Checkpoint.__table__.insert(),
+                                 [{'name': self.checkpoint, 'key': key} for key in self.keys])
+        self.session.commit()
+        self.buffer     = []
+        self.keys       = []
+        self.n_pending  = 0
+        self.last_flush = time()
+        self.db_secs   += self.last_flush - t
+
+    def _begin(self):
+        """
+        Starts the transaction in which the outputs are written and their inputs recorded as completed, after
+        committing anything written before, e.g. by UDF.apply. The Postgres engine is in AUTOCOMMIT mode, so
+        there the connection is switched to a transactional isolation level until the commit; otherwise an
+        interrupted flush could leave outputs without ledger rows, and fail on resume with duplicate keys.
+        """
+        self.session.commit()
+        if snorkel_postgres:
+            self.session.connection(execution_options={'isolation_level': 'READ COMMITTED'})
+
+
+def default_flush_size(flush_size, flush_secs):
+    """Returns flush_size, or WRITER_COMMIT_SIZE if no flush policy is set, so that buffered outputs stay bounded"""
+    return flush_size if flush_size is not None or flush_secs is not None else WRITER_COMMIT_SIZE
+
+
+def bulk_insert(session, objs):
+    """
+    Inserts new ORM objects with Core executemany INSERTs, bypassing the unit of work: the objects of each
+    class are inserted together, with one INSERT per table (i.e. also into the parent tables, with joined
+    table inheritance), and their ids assigned in one block (see insert_rows). New objects which they are
+    related to (e.g. the new Spans of Candidates in single-writer mode) are inserted too, those referenced
+    by foreign keys first, and these are set from their ids.
+    """
+    # Collect the new objects, and the depth of each in the graph of many-to-one relationships between them
+    depths = {}
+    order  = []
+    for obj in objs:
+        _visit_new(obj, depths, order)
+
+    # Insert the objects of each class at each depth together
+    groups = OrderedDict()
+    for obj in sorted(order, key=lambda obj: depths[id(obj)]):
+        groups.setdefault((depths[id(obj)], inspect(obj).mapper), []).append(obj)
+    for (_, mapper), group in groups.items():
+        _insert_objects(session, mapper, group)
+
+
+def _is_new(obj):
+    state = inspect(obj)
+    return state.key is None and None in state.mapper.primary_key_from_instance(obj)
+
+
+def _visit_new(obj, depths, order):
+    """Sets the depths of obj and the new objects related to it, returning that of obj; see bulk_insert"""
+    if id(obj) in depths:
+        return depths[id(obj)]
+    depths[id(obj)] = 0
+    order.append(obj)
+
+    # Objects added to a session e.g. by a backref cascade would otherwise be inserted again on commit
+    state = inspect(obj)
+    if state.pending:
+        object_session(obj).expunge(obj)
+    depth = 0
+    for r in state.mapper.relationships:
+        value   = state.dict.get(r.key)
+        related = [value] if r.direction is MANYTOONE else list(value or []) if r.direction is ONETOMANY else []
+        for other in related:
+            if other is not None and _is_new(other):
+                other_depth = _visit_new(other, depths, order)
+                if r.direction is MANYTOONE:
+                    depth = max(depth, other_depth + 1)
+    depths[id(obj)] = max(depths[id(obj)], depth)
+    return depths[id(obj)]
+
+
+def _insert_objects(session, mapper, objs):
+    """Inserts new objects of a single mapped class, and sets their ids; see bulk_insert"""
+    tables = []
+    for m in reversed(list(mapper.iterate_to_root())):
+        if m.local_table not in tables:
+            tables.append(m.local_table)
+
+    # Foreign keys are set from the objects referenced through relationships, if any
+    fks = {}
+    for r in mapper.relationships:
+        if r.direction is MANYTOONE:
+            for local, remote in r.local_remote_pairs:
+                fks[local] = (r.key, remote)
+
+    # Objects without an id are assigned theirs with the insert into the base table, in one block
+    pk     = list(tables[0].primary_key.columns)
+    pk_key = mapper.get_property_by_column(pk[0]).key
+    rows   = [_column_values(mapper, obj, tables[0], fks) for obj in objs]
+    if len(pk) == 1:
+        new = [i for i, obj in enumerate(objs) if getattr(obj, pk_key) is None]
+        insert_rows(session, tables[0], [rows[i] for i in new])
+        for i in new:
+            setattr(objs[i], pk_key, rows[i][pk[0].key])
+        new  = set(new)
+        rows = [row for i, row in enumerate(rows) if i not in new]
+    if len(rows) > 0:
+        session.execute(tables[0].insert(), rows)
+    for table in tables[1:]:
+        session.execute(table.insert(), [_column_values(mapper, obj, table, fks) for obj in objs])
+
+
+def _column_values(mapper, obj, table, fks):
+    """Returns the values of the columns of one of the tables of a mapped object, as a dict of column keys"""
+    state = inspect(obj)
+    row   = {}
+    for column in table.columns:
+        value = state.dict.get(mapper.get_property_by_column(column).key)
+        if column in fks and state.dict.get(fks[column][0]) is not None:
+            other = state.dict[fks[column][0]]
+            value = getattr(other, inspect(other).mapper.get_property_by_column(fks[column][1]).key)
+        elif value is None and column is mapper.polymorphic_on:
+            value = mapper.polymorphic_identity
+        elif value is None and column.default is not None and column.default.is_scalar:
+            value = column.default.arg
+        row[column.key] = value
+    return row
+
+
+class WorkerStats(object):
+    """
+    Counters and timings of one worker (UDF process or thread, or the main process when running
+    single-threaded, or the writer of outputs sent back to the main process) for one run
+    """
+    def __init__(self, worker):
+        self.worker     = worker
+        self.n_batches  = 0
+        self.n_inputs   = 0
+        self.n_outputs  = 0
+        self.wait_secs  = 0.0
+        self.apply_secs = 0.0
+        self.db_secs    = 0.0
+
+        # Seconds per input of each batch, and lengths of the output queue as batches were taken off it
+        self.latencies  = []
+        self.backlog    = []
+
+    def add_batch(self, n_inputs, n_outputs, secs):
+        self.n_batches  += 1
+        self.n_inputs   += n_inputs
+        self.n_outputs  += n_outputs
+        self.apply_secs += secs
+        if n_inputs > 0:
+            self.latencies.append(secs / n_inputs)
+
+    def sample_backlog(self, queue):
+        try:
+            self.backlog.append(queue.qsize())
+        except NotImplementedError:
+            pass
+
+    def summary(self, secs=None):
+        """Returns a dict of the counters and timings, with apply latency percentiles and throughput"""
+        d = {
+            'worker'      : self.worker,
+            'n_batches'   : self.n_batches,
+            'n_inputs'    : self.n_inputs,
+            'n_outputs'   : self.n_outputs,
+            'wait_secs'   : self.wait_secs,
+            'apply_secs'  : self.apply_secs,
+            'db_secs'     : self.db_secs,
+            'latency_p50' : np.percentile(self.latencies, 50) if self.latencies else None,
+            'latency_p99' : np.percentile(self.latencies, 99) if self.latencies else None,
+            'backlog_max' : max(self.backlog) if self.backlog else None,
+            'backlog_mean': np.mean(self.backlog) if self.backlog else None
+        }
+        busy_secs = secs if secs is not None else self.wait_secs + self.apply_secs + self.db_secs
+        d['items_per_sec'] = self.n_inputs / busy_secs if busy_secs > 0 else None
+        return d
+
+
+class UDFStats(object):
+    """
+    Counters and timings of a run of a UDF, per worker (see WorkerStats) and overall, as returned by
+    UDFRunner.apply
+    """
+    def __init__(self, udf_name, workers, secs, completed=True):
+        self.udf_name  = udf_name
+        self.workers   = workers
+        self.secs      = secs
+        self.completed = completed
+
+    def total(self):
+        """Returns the summed counters and timings of all the workers, as a WorkerStats"""
+        total = WorkerStats('total')
+        for w in self.workers:
+            total.n_batches  += w.n_batches
+            total.n_inputs   += w.n_inputs
+            total.n_outputs  += w.n_outputs
+            total.wait_secs  += w.wait_secs
+            total.apply_secs += w.apply_secs
+            total.db_secs    += w.db_secs
+            total.latencies.extend(w.latencies)
+            total.backlog.extend(w.backlog)
+        return total
+
+    def summary(self):
+        """Returns a dict of the overall counters and timings, with throughput over the whole run"""
+        d = self.total().summary(secs=self.secs)
+        d.update({'udf': self.udf_name, 'secs': self.secs, 'completed': self.completed})
+        return d
+
+    def write_json(self, path):
+        """Appends the stats to the file at path as JSON lines: one per worker, then the overall summary"""
+        with open(path, 'a') as f:
+            for w in self.workers:
+                d = w.summary()
+                d['udf'] = self.udf_name
+                f.write(json.dumps(d) + '\n')
+            f.write(json.dumps(self.summary()) + '\n')
+
+    def __repr__(self):
+        d = self.summary()
+        return "%s (%s: %d inputs, %d outputs in %.2fs; %.1f inputs/s)" % (self.__class__.__name__,
+            self.udf_name, d['n_inputs'], d['n_outputs'], self.secs, d['items_per_sec'] or 0.0)
+
+
+def picklable_items(d):
+    """Returns a copy of dict d without the items whose values cannot be pickled"""
+    items = {}
+    for key, value in d.items():
+        try:
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            items[key] = value
+        except Exception:
+            continue
+    return items
+
+
+class QueueClosed(object):
+    """Sentinel put on a queue, once per consumer, to signal that no more objects will follow"""
+    pass
+
+
+class QueueFeeder(Thread):
+    """
+    Producer thread which consumes an iterable of input objects and puts them into a bounded queue,
+    followed by one QueueClosed sentinel per consumer. Blocks while the queue is full, so that at most
+    the queue's maxsize objects are held in memory at any time.
+    """
+    def __init__(self, xs, queue, n_consumers=1):
+        Thread.__init__(self)
+        self.daemon      = True
+        self.xs          = xs
+        self.queue       = queue
+        self.n_consumers = n_consumers
+        self.stopped     = Event()
+        self.error       = None
+
+    def run(self):
+        try:
+            for x in self.xs:
+                if not self._put(x):
+                    return
+        except Exception as e:
+            # Re-raised by the runner on the main thread after join()
+            self.error = e
+        finally:
+            for _ in range(self.n_consumers):
+                if not self._put(QueueClosed()):
+                    break
+
+    def _put(self, x):
+        """Put x into the queue, giving up if stop() is called while waiting for space"""
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(x, True, QUEUE_TIMEOUT)
+                return True
+            except Full:
+                continue
+        return False
+
+    def stop(self):
+        self.stopped.set()
+
+
+class UDFProgress(object):
+    """
+    A snapshot of the progress of a parallel run of a UDF, as passed to UDFRunner.apply's progress_callback.
+    workers is a list with a dict for each UDF process, with the number of inputs it has processed, the
+    seconds since it last finished a batch, and whether it is alive.
+    """
+    def __init__(self, n_done, n_total, secs, workers):
+        self.n_done  = n_done
+        self.n_total = n_total
+        self.secs    = secs
+        self.workers = workers
+
+    @property
+    def rate(self):
+        """Inputs processed per second"""
+        return self.n_done / self.secs if self.secs > 0 else 0.0
+
+    @property
+    def eta(self):
+        """Estimated seconds remaining, if the total number of inputs is known"""
+        if self.n_total is None or self.rate == 0:
+            return None
+        return max(0, self.n_total - self.n_done) / self.rate
+
+    def __repr__(self):
+        total = "/%d" % self.n_total if self.n_total is not None else ""
+        eta   = ", ETA %ds" % self.eta if self.eta is not None else ""
+        alive = sum(1 for w in self.workers if w['alive'])
+        return "%d%s inputs, %.1f/s%s, %d/%d workers alive" % (self.n_done, total, self.rate, eta, alive,
+            len(self.workers))
+
+
+class ProgressMonitor(Thread):
+    """
+    Thread which reports the progress of a parallel run of a UDF every interval seconds, from the counters
+    in shared memory which the UDF processes increment: shows it if show is True, and passes it to callback
+    as a UDFProgress, if set
+    """
+    def __init__(self, runner, n_total=None, show=True, callback=None, interval=PROGRESS_INTERVAL):
+        Thread.__init__(self)
+        self.daemon   = True
+        self.runner   = runner
+        self.n_total  = n_total
+        self.show     = show
+        self.callback = callback
+        self.interval = interval
+        self.start_t  = time()
+        self.stopped  = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.update()
+        self.update()
+        if self.show:
+            sys.stdout.write("\n\n")
+            sys.stdout.flush()
+
+    def update(self):
+        now     = time()
+        workers = [{
+            'worker'    : i,
+            'n_inputs'  : self.runner.progress[i],
+            'idle_secs' : now - self.runner.last_active[i],
+            'alive'     : udf.is_alive()
+        } for i, udf in enumerate(self.runner.udfs)]
+        progress = UDFProgress(sum(w['n_inputs'] for w in workers), self.n_total, now - self.start_t, workers)
+        if self.show:
+            sys.stdout.write("\r" + repr(progress) + " " * 10)
+            sys.stdout.flush()
+        if self.callback is not None:
+            self.callback(progress)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class UDFThread(Thread):
+    """
+    Runs a UDF on a thread rather than as a Process, providing the parts of the Process interface which
+    UDFRunner uses. Note that threads cannot be terminated; they exit once their in_queue is closed.
+    """
+    def __init__(self, udf):
+        Thread.__init__(self)
+        self.daemon    = True
+        self.udf       = udf
+        self.ctl_queue = udf.ctl_queue
+        self.exitcode  = None
+
+    def run(self):
+        try:
+            self.udf.run()
+            self.exitcode = 0
+        except Exception:
+            traceback.print_exc()
+            self.exitcode = 1
+
+    def terminate(self):
+        pass
 
 
 class UDF(Process):
-    def __init__(self, in_queue=None, out_queue=None):
+    def __init__(self, in_queue=None, out_queue=None, ctl_queue=None, done_queue=None):
         """
         in_queue: A Queue of input objects to process; primarily for running in parallel
+        ctl_queue, done_queue: If set, the UDF process is kept alive across runs: it gets the settings for
+            each run from ctl_queue (None to exit), and signals done_queue at the end of each
         """
         Process.__init__(self)
         self.daemon       = True
         self.in_queue     = in_queue
         self.out_queue    = out_queue
+        self.ctl_queue    = ctl_queue
+        self.done_queue   = done_queue
 
         # Each UDF starts its own Engine
         # See http://docs.sqlalchemy.org/en/latest/core/pooling.html#using-connection-pools-with-multiprocessing
@@ -145,27 +876,131 @@ class UDF(Process):
         # We use a workaround to pass in the apply kwargs
         self.apply_kwargs = {}
 
+        # If True, the UDF is run in single-writer mode, and should not write to the database itself:
+        # its outputs are sent back to the parent process, which writes them
+        self.single_writer = False
+
+        # Flush policy for writing the outputs when running as a Process, see OutputWriter
+        self.flush_size = None
+        self.flush_secs = None
+
+        # Name of the progress ledger in which to record completed inputs, and skip these, if any
+        self.checkpoint = None
+
+        # Index of the UDF among those run in parallel, for reporting its WorkerStats, and the progress
+        # counters in shared memory it updates, if any
+        self.worker_id   = 0
+        self.progress    = None
+        self.last_active = None
+
     def run(self):
         """
         This method is called when the UDF is run as a Process in a multiprocess setting
-        The basic routine is: get from JoinableQueue, apply, put / add outputs, loop
+        If kept alive, the UDF processes the inputs of one run after another, until told to exit
+        """
+        if self.ctl_queue is None:
+            self.done_queue.put((self.worker_id, self.process_queue()))
+        else:
+            while True:
+                settings = self.ctl_queue.get()
+                if settings is None:
+                    break
+                for name, value in settings.items():
+                    setattr(self, name, value)
+                self.done_queue.put((self.worker_id, self.process_queue()))
+        self.shutdown()
+        self.session.close()
+
+    def process_queue(self):
         """
+        The basic routine is: get a batch from JoinableQueue, apply, put / add outputs, loop until
+        a QueueClosed sentinel is received; returns the WorkerStats of the run
+        """
+        # If the reduce step can be run on batches, each UDF process runs it on its own outputs
+        writer = OutputWriter(self.session, flush_size=default_flush_size(self.flush_size, self.flush_secs),
+                              flush_secs=self.flush_secs, reducer=self if hasattr(self, 'reduce_batch') else None,
+                              reduce_kwargs=self.apply_kwargs, checkpoint=self.checkpoint)
+        stats  = WorkerStats(self.worker_id)
         while True:
-            try:
-                x = self.in_queue.get(True, QUEUE_TIMEOUT)
-                for y in self.apply(x, **self.apply_kwargs):
-
-                    # If an out_queue is provided, add to that, else add to session
-                    if self.out_queue is not None:
-                        self.out_queue.put(y, True, QUEUE_TIMEOUT)
-                    else:
-                        self.session.add(y)
+            t  = time()
+            xs = self.in_queue.get()
+            stats.wait_secs += time() - t
+            if isinstance(xs, QueueClosed):
                 self.in_queue.task_done()
-            except Empty:
                 break
-        self.session.commit()
-        self.session.close()
+            n_inputs = len(xs)
+            keys, ys = self.process_batch(xs, stats, **self.apply_kwargs)
+
+            # If an out_queue is provided, add the outputs to that as one list along with the input keys,
+            # else write them
+            if self.out_queue is not None:
+                self._put_output((keys, ys))
+            else:
+                for y in ys:
+                    writer.write(y)
+                writer.done(keys)
+            self.in_queue.task_done()
+            if self.progress is not None:
+                self.progress[self.worker_id]   += n_inputs
+                self.last_active[self.worker_id] = time()
+        if self.out_queue is not None:
+            self._put_output(QueueClosed())
+        writer.flush()
+        stats.db_secs += writer.db_secs
+        return stats
+
+    def _put_output(self, out):
+        """Put out into the out_queue, which is bounded, waiting while it is full for the writer to catch up"""
+        while True:
+            try:
+                self.out_queue.put(out, True, QUEUE_TIMEOUT)
+                return
+            except Full:
+                continue
+
+    def process_batch(self, xs, stats, **kwargs):
+        """
+        Applies the UDF to a batch of inputs, skipping those already completed if resuming from a
+        checkpoint, and recording timings in stats; returns the keys of the inputs and a list of outputs
+        """
+        t    = time()
+        keys = None
+        if self.checkpoint is not None:
+            xs, keys = self.skip_completed(xs)
+        stats.db_secs += time() - t
+
+        t  = time()
+        ys = list(self.apply_batch(xs, **kwargs)) if len(xs) > 0 else []
+        stats.add_batch(len(xs), len(ys), time() - t)
+        return keys, ys
 
     def apply(self, x, **kwargs):
         """This function takes in an object, and returns a generator / set / list"""
         raise NotImplementedError()
+
+    def apply_batch(self, xs, **kwargs):
+        """
+        This function takes in a list of objects, and returns a generator / set / list of the outputs
+        for all of them. By default calls apply() on each object; override e.g. to load a whole batch
+        of inputs from the database at once.
+        """
+        for x in xs:
+            for y in self.apply(x, **kwargs):
+                yield y
+
+    def shutdown(self):
+        """Releases any resources held by the UDF, e.g. parser connections, once it will not be applied again"""
+        pass
+
+    def get_input_key(self, x):
+        """Returns a string uniquely identifying input x, e.g. its stable_id, for recording in a checkpoint"""
+        raise NotImplementedError()
+
+    def skip_completed(self, xs):
+        """Returns the inputs in xs not yet recorded as completed in the checkpoint, and their keys"""
+        keys = [self.get_input_key(x) for x in xs]
+        q    = select([Checkpoint.key]).where(Checkpoint.name == self.checkpoint)\
+                                       .where(Checkpoint.key.in_(keys))
+        done = set(key for key, in self.session.execute(q))
+        todo = [(x, key) for x, key in zip(xs, keys) if key not in done]
+        return [x for x, _ in todo], [key for _, key in todo]
@@ -40,6 +40,39 @@ def get_ORM_instance(ORM_class, session, instance):
         return instance
 
 
+def paged_query(query, id_column, page_size=10000):
+    """
+    Lazily iterate over the rows of a query whose first selected column is id_column, using keyset
+    pagination: rows are loaded page_size at a time, in order of id_column, so that memory use is
+    bounded and no cursor or transaction is held open between pages (e.g. with AUTOCOMMIT on Postgres).
+
+    Note: The query must not already have an ORDER BY, LIMIT or OFFSET applied, and should be bound
+    to a dedicated session, which is closed after each page to release its connection.
+    """
+    last_id = None
+    while True:
+        q = query if last_id is None else query.filter(id_column > last_id)
+        page = q.order_by(id_column).limit(page_size).all()
+        query.session.close()
+        for row in page:
+            yield row
+        if len(page) < page_size:
+            return
+        last_id = page[-1][0]
+
+
+def batch_iter(xs, batch_size):
+    """Lazily iterate over an iterable in lists of (up to) batch_size consecutive elements"""
+    batch = []
+    for x in xs:
+        batch.append(x)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
 def camel_to_under(name):
     """
     Converts camel-case string to lowercase string separated by underscores.
@@ -0,0 +1,59 @@
+import os, sys, unittest
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from snorkel.candidates import DictionaryNgrams, Ngrams
+from snorkel.matchers import DictionaryMatch
+from snorkel.models import Sentence
+
+
+def make_sentence(words):
+    """Returns a Sentence of the words, separated by single spaces"""
+    text = ' '.join(words)
+    return Sentence(text=text, words=words, char_offsets=[len(' '.join(words[:i] + [''])) for i in range(len(words))])
+
+
+class TestNgrams(unittest.TestCase):
+
+    def test_split_tokens(self):
+        """Tests that Ngrams also returns both parts of the single tokens containing a split token"""
+        sent  = make_sentence(['We', 'found', 'disease', 'A/B', 'in', 'cow', 'Alpha-3', '.'])
+        spans = [ts.get_span() for ts in Ngrams(n_max=1).apply(sent)]
+        self.assertEqual(sorted(spans), sorted(sent.words + ['A', 'B', 'Alpha', '3']))
+        self.assertEqual(len(list(Ngrams(n_max=2).apply(sent))), 8 + 7 + 4)
+        self.assertEqual(sorted(ts.get_span() for ts in Ngrams(n_max=1, split_tokens=None).apply(sent)),
+                         sorted(sent.words))
+
+
+class TestDictionaryNgrams(unittest.TestCase):
+
+    def test_dictionary_ngrams(self):
+        """Tests that DictionaryNgrams returns the same spans as Ngrams with a DictionaryMatch"""
+        words = ['Alice', 'Smith', 'met', 'Bob', 'Smith', 'and', 'alice', 'in', 'New', 'York', 'City', '.']
+        sent  = make_sentence(words)
+        d     = ['alice', 'Alice Smith', 'Bob', 'Smith', 'York', 'New York', 'York City', 'New York City Hall']
+        spans = sorted(ts.get_span() for ts in DictionaryNgrams(d=d).apply(sent))
+        self.assertEqual(spans, ['Alice Smith', 'Bob', 'New York', 'Smith', 'York City', 'alice'])
+        self.assertEqual(spans, sorted(ts.get_span() for ts in DictionaryMatch(d=d).apply(Ngrams().apply(sent))))
+
+        all_spans = DictionaryNgrams(d=d, ignore_case=False, longest_match_only=False).apply(sent)
+        self.assertEqual(len(list(all_spans)), 8)
+
+    def test_split_tokens(self):
+        """Tests that DictionaryNgrams matches the parts of split tokens, as Ngrams with a DictionaryMatch"""
+        words = ['levodopa/carbidopa', 'induced', 'dyskinesia', 'and', 'levodopa-carbidopa', '.']
+        sent  = make_sentence(words)
+        d     = ['carbidopa', 'levodopa', 'dyskinesia', 'levodopa-carbidopa']
+        spans = sorted(ts.get_span() for ts in DictionaryNgrams(d=d).apply(sent))
+        self.assertEqual(spans, ['carbidopa', 'dyskinesia', 'levodopa', 'levodopa-carbidopa'])
+        self.assertEqual(sorted(ts.get_span() for ts in DictionaryNgrams(d=d, longest_match_only=False).apply(sent)),
+                         ['carbidopa', 'carbidopa', 'dyskinesia', 'levodopa', 'levodopa', 'levodopa-carbidopa'])
+        self.assertEqual(sorted(ts.get_span() for ts in DictionaryNgrams(d=d, split_tokens=None).apply(sent)),
+                         ['dyskinesia', 'levodopa-carbidopa'])
+
+        # Ngrams returns every part, which DictionaryMatch filters without the longest-match rule
+        matched = DictionaryMatch(d=d, longest_match_only=False).apply(Ngrams().apply(sent))
+        self.assertEqual(sorted(ts.get_span() for ts in matched),
+                         sorted(ts.get_span() for ts in DictionaryNgrams(d=d, longest_match_only=False).apply(sent)))
+
+
+if __name__ == '__main__':
+    unittest.main()
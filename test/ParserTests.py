@@ -1,6 +1,11 @@
-import os, requests, sys, unittest
+import json, multiprocessing, os, re, requests, shutil, subprocess, sys, tempfile, threading, unittest, warnings
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 from six.moves.cPickle import load
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from time import sleep
+from snorkel.contrib.parser import SpaCy
+from snorkel.models import Candidate, Context, Document, SnorkelSession, Sentence
 from snorkel.parser import *
 
 ROOT = os.environ['SNORKELHOME']
@@ -37,5 +42,514 @@ class TestParsers(unittest.TestCase):
         self.assertEqual(corpus.get_docs(), gold_docs)
         self.assertEqual(corpus.get_contexts(), gold_sents)
 
+
+class TestParseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'parses.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_parse_cache(self):
+        """Tests that ParseCache stores values by text and configuration"""
+        cache = ParseCache(self.path, config='a')
+        self.assertEqual(cache.get_many([u'Hello.', u'World.']), [None, None])
+        cache.put_many([(u'Hello.', [[{'tokens': []}], 0])])
+        self.assertEqual(cache.get_many([u'World.', u'Hello.']), [None, [[{'tokens': []}], 0]])
+        self.assertEqual(len(cache), 1)
+
+        # The cache is persistent, and keyed by parser configuration
+        self.assertEqual(ParseCache(self.path, config='a').get_many([u'Hello.']), [[[{'tokens': []}], 0]])
+        self.assertEqual(ParseCache(self.path, config='b').get_many([u'Hello.']), [None])
+
+
+def fake_corenlp_request(text, conn):
+    """
+    Stands in for StanfordCoreNLPServer._request: returns the JSON sentence blocks of text, with one token per
+    run of non-whitespace characters, and a sentence ending at each token ending with a period
+    """
+    blocks, tokens = [], []
+    for m in re.finditer(r'\S+', text):
+        tokens.append({'word': m.group(), 'lemma': m.group().lower(), 'pos': 'NN', 'ner': 'O',
+                       'originalText': m.group(), 'characterOffsetBegin': m.start(), 'characterOffsetEnd': m.end()})
+        if m.group().endswith('.'):
+            blocks.append(tokens)
+            tokens = []
+    if len(tokens) > 0:
+        blocks.append(tokens)
+    return [{'tokens': tokens, 'basic-dependencies': [{'governor': 0, 'dep': 'dep', 'dependent': i + 1}
+                                                       for i in range(len(tokens))]} for tokens in blocks]
+
+
+class TestCoreNLPRequests(unittest.TestCase):
+
+    TEXTS = [
+        u'  Leading whitespace. Then a second sentence.',
+        u'',
+        u'   ',
+        u'One sentence only.',
+        u'No period at the end',
+        u'A sentence\nover two lines. And another one.',
+        u'Last document.'
+    ]
+
+    def parser(self, **kwargs):
+        parser = StanfordCoreNLPServer(urls=['http://127.0.0.1:1'], **kwargs)
+        parser._request = fake_corenlp_request
+        return parser
+
+    def docs(self):
+        return [(Document(name='doc%d' % i, stable_id='doc%d::document:0:0' % i, meta={}), text)
+                for i, text in enumerate(self.TEXTS)]
+
+    def parse(self, parses, docs):
+        """Returns the Sentence parts of parses, without the Document objects, and the resulting Document meta"""
+        parts = [dict((k, v) for k, v in p.items() if k != 'document') for p in parses]
+        return parts, [doc.meta for doc, _ in docs]
+
+    def expected(self):
+        """Returns the parses of the documents parsed one at a time"""
+        parser, docs = self.parser(), self.docs()
+        return self.parse([p for doc, text in docs for p in parser.parse(doc, text, None)], docs)
+
+    def test_pack_documents(self):
+        """Tests that packing documents into requests gives the same parses as parsing them one by one"""
+        expected = self.expected()
+        self.assertEqual(len(expected[0]), 7)
+        self.assertEqual(expected[0][0]['stable_id'], 'doc0::sentence:2:21')
+        for max_chars in [20, 50, 100000]:
+            parser, docs = self.parser(max_chars=max_chars), self.docs()
+            with warnings.catch_warnings(record=True):
+                # Otherwise Python 2 records the warnings in the module's registry, and would not show them again
+                warnings.simplefilter('always')
+                self.assertEqual(self.parse(parser.parse_batch(docs, None), docs), expected)
+
+    def test_sentence_across_documents(self):
+        """Tests that documents are parsed separately if a sentence of their request spans them"""
+        parser, docs = self.parser(), self.docs()[3:6]
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            parses = self.parse(parser.parse_batch(docs, None), docs)
+        self.assertTrue(any('spans documents' in str(warning.message) for warning in w))
+        self.assertEqual(parses[0], [p for p in self.expected()[0] if p['stable_id'].split('::')[0] in
+                                     ['doc3', 'doc4', 'doc5']])
+
+    def test_split_text(self):
+        """Tests that long texts are split into chunks at paragraph breaks, else sentence ends, else whitespace"""
+        parser = self.parser()
+        text = u'First sentence. Second one.\n\nNew paragraph here. Wordswithoutanyspaceatall and more'
+        spans = parser.split_text(text, 30)
+        self.assertEqual([text[start:end] for start, end in spans],
+                         [u'First sentence. Second one.\n\n', u'New paragraph here. ', u'Wordswithoutanyspaceatall and ',
+                          u'more'])
+        self.assertEqual(parser.split_text(u'x' * 25, 10), [(0, 10), (10, 20), (20, 25)])
+
+    def test_chunk_documents(self):
+        """Tests that documents longer than chunk_chars are parsed in chunks and merged back the same"""
+        expected = self.expected()
+        self.assertEqual(len(self.parser().split_text(self.TEXTS[0], 30)), 2)
+        for max_in_flight in [1, 3]:
+            parser, docs = self.parser(chunk_chars=30, max_in_flight=max_in_flight), self.docs()
+            self.assertEqual(self.parse(parser.parse_batch(docs, None), docs), expected)
+            parser, docs = self.parser(chunk_chars=30, max_in_flight=max_in_flight), self.docs()
+            self.assertEqual(self.parse([p for doc, text in docs for p in parser.parse(doc, text, None)], docs),
+                             expected)
+
+
+class FakeCoreNLPServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for a CoreNLP server, parsing with fake_corenlp_request on a thread per request; requests for
+    texts containing 'slow' take longer, and the maximum number of requests handled at once is recorded
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeCoreNLPHandler)
+        self.lock = threading.Lock()
+        self.n_active = 0
+        self.max_active = 0
+        self.n_requests = 0
+        threading.Thread(target=self.serve_forever).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+
+class FakeCoreNLPHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        with self.server.lock:
+            self.server.n_active += 1
+            self.server.max_active = max(self.server.max_active, self.server.n_active)
+            self.server.n_requests += 1
+        text = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        sleep(0.3 if 'slow' in text else 0.05)
+        content = json.dumps({'sentences': fake_corenlp_request(text, None)}).encode('utf-8')
+        with self.server.lock:
+            self.server.n_active -= 1
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        # Health check, as for /ping
+        self.send_response(200)
+        self.send_header('Content-Length', '4')
+        self.end_headers()
+        self.wfile.write(b'pong')
+
+    def log_message(self, *args):
+        pass
+
+
+def settled_thread_count(secs=2):
+    """Returns the number of threads once it stops changing, e.g. as server threads of closed connections exit"""
+    n = threading.active_count()
+    for _ in range(int(secs / 0.1)):
+        sleep(0.1)
+        if threading.active_count() == n:
+            break
+        n = threading.active_count()
+    return n
+
+
+class TestConcurrentURLParserConnection(unittest.TestCase):
+
+    TEXTS = [u'This one is slow.', u'Fast one.', u'Another slow one. Two sentences.', u'Fast again.',
+             u'Third slow one.', u'Last.']
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeCoreNLPServer()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def docs(self):
+        return [(Document(name='doc%d' % i, stable_id='doc%d::document:0:0' % i, meta={}), text)
+                for i, text in enumerate(self.TEXTS)]
+
+    def test_in_order(self):
+        """Tests that parses are returned in document order with several requests in flight"""
+        expected = [p['text'] for p in StanfordCoreNLPServer(urls=[self.server.url]).connect().parse_batch(self.docs())]
+        self.assertEqual(len(expected), 7)
+        for docs_per_request in [1, 2]:
+            self.server.max_active = 0
+            conn = StanfordCoreNLPServer(urls=[self.server.url], max_in_flight=3,
+                                         docs_per_request=docs_per_request).connect()
+            self.assertIsInstance(conn, ConcurrentURLParserConnection)
+            self.assertEqual([p['text'] for p in conn.parse_batch(self.docs())], expected)
+            self.assertGreater(self.server.max_active, 1)
+            conn.close()
+            self.assertIsNone(conn.pool)
+
+    def test_close(self):
+        """Tests that the threads of the connection are stopped once CorpusParser is done with it"""
+        udf = CorpusParserUDF(parser=StanfordCoreNLPServer(urls=[self.server.url], max_in_flight=3), fn=None)
+        self.assertEqual(len(list(udf.apply_batch(self.docs()))), 7)
+        self.assertIsNotNone(udf.req_handler.pool)
+        udf.shutdown()
+        self.assertIsNone(udf.req_handler.pool)
+
+        n_threads = settled_thread_count()
+        parser = CorpusParser(parser=StanfordCoreNLPServer(urls=[self.server.url], max_in_flight=3))
+        parser.apply(self.docs(), batch_size=3, progress_bar=False)
+        session = SnorkelSession()
+        self.assertEqual(session.query(Sentence).count(), 7)
+        session.query(Candidate).delete()
+        session.query(Context).delete()
+        session.commit()
+        session.close()
+        self.assertEqual(settled_thread_count(), n_threads)
+
+
+class TestEndpointPool(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.servers = [FakeCoreNLPServer(), FakeCoreNLPServer()]
+
+        # A URL at which no server listens
+        server = HTTPServer(('127.0.0.1', 0), BaseHTTPRequestHandler)
+        cls.dead_url = 'http://127.0.0.1:%d' % server.server_address[1]
+        server.server_close()
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.shutdown()
+            server.server_close()
+
+    def docs(self):
+        texts = TestConcurrentURLParserConnection.TEXTS * 2
+        return [(Document(name='doc%d' % i, stable_id='doc%d::document:0:0' % i, meta={}), text)
+                for i, text in enumerate(texts)]
+
+    def test_load_balancing(self):
+        """Tests that requests are spread across the servers, with parses returned in document order"""
+        expected = [p['text'] for p in StanfordCoreNLPServer(urls=[self.servers[0].url]).connect().parse_batch(self.docs())]
+        self.assertEqual(len(expected), 14)
+        for server in self.servers:
+            server.n_requests = 0
+        parser = StanfordCoreNLPServer(urls=[server.url for server in self.servers], max_in_flight=4)
+        self.assertIsNotNone(parser.endpoint_pool)
+        conn = parser.connect()
+        self.assertEqual([p['text'] for p in conn.parse_batch(self.docs())], expected)
+        conn.close()
+        self.assertEqual(sum(server.n_requests for server in self.servers), 12)
+        self.assertTrue(all(server.n_requests >= 4 for server in self.servers))
+        self.assertEqual(list(parser.endpoint_pool.outstanding.values()), [0, 0])
+
+    def test_failover(self):
+        """Tests that requests to a server which is down are retried on another, which is then used alone"""
+        parser = StanfordCoreNLPServer(urls=[self.dead_url, self.servers[0].url], max_in_flight=3)
+        pool = parser.endpoint_pool
+        dead, live = parser.endpoints
+        conn = parser.connect()
+        self.assertEqual(len(list(conn.parse_batch(self.docs()))), 14)
+        conn.close()
+        self.assertIn(dead, pool.suspect)
+        self.assertNotIn(live, pool.suspect)
+        self.assertGreater(pool.down_until[dead], 0)
+
+        # Endpoints are health checked before being used again
+        self.assertFalse(pool.check_health(conn.request, dead))
+        self.assertTrue(pool.check_health(conn.request, live))
+
+        # With no server available, requests fail once wait_secs have passed
+        parser = StanfordCoreNLPServer(urls=[self.dead_url, self.dead_url + '/'])
+        parser.endpoint_pool.wait_secs = 0
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            list(parser.connect().parse_batch(self.docs()[:1]))
+
+
+class TestRuleBasedParser(unittest.TestCase):
+
+    def test_rule_based_parser(self):
+        """Tests tokenization, sentence splitting and NER patterns of the RuleBasedParser"""
+        text = u'Dr. Smith moved to the U.S. in 1999. "Why?" she asked.\n\nNo title'
+        parser = RuleBasedParser(ner_patterns=[('DATE', r'\b\d{4}\b')])
+        sents = list(parser.connect().parse(None, text))
+        self.assertEqual([s['text'] for s in sents],
+                         [u'Dr. Smith moved to the U.S. in 1999.', u'"Why?"', u'she asked.', u'No title'])
+        self.assertEqual(sents[0]['words'], [u'Dr.', u'Smith', u'moved', u'to', u'the', u'U.S.', u'in', u'1999', u'.'])
+        self.assertEqual(sents[0]['char_offsets'], [0, 4, 10, 16, 19, 23, 28, 31, 35])
+        self.assertEqual(sents[0]['ner_tags'], ['O'] * 7 + ['DATE', 'O'])
+        self.assertEqual(sents[3]['position'], 3)
+
+        # Fields which are not annotated are empty, for each token
+        sents = list(RuleBasedParser().connect().parse(None, text))
+        for s in sents:
+            for field in ['lemmas', 'pos_tags', 'ner_tags', 'dep_labels']:
+                self.assertEqual(s[field], [u''] * len(s['words']))
+            self.assertEqual(s['dep_parents'], [0] * len(s['words']))
+
+
+class FakeSpaCyToken(object):
+    """Stands in for a spaCy Token"""
+    def __init__(self, doc, i, m):
+        self.doc = doc
+        self.i = i
+        self.text = m.group()
+        self.idx = m.start()
+        self.is_space = self.text.isspace()
+        self.lemma_ = self.text.lower()
+        self.tag_ = 'NN'
+        self.ent_type_ = 'PERSON' if self.text.istitle() else ''
+        self.dep_ = 'dep'
+        self.head_i = i
+
+    @property
+    def head(self):
+        return self.doc.tokens[self.head_i]
+
+
+class FakeSpaCyDoc(object):
+    """
+    Stands in for a spaCy Doc: tokens are runs of non-whitespace characters, and newlines, which are whitespace
+    tokens; a sentence ends at each token ending with a period; and the head of each (non-whitespace) token is
+    the next one, the last of each sentence being its root
+    """
+    def __init__(self, text):
+        self.text = text
+        self.tokens = [FakeSpaCyToken(self, i, m) for i, m in enumerate(re.finditer(r'\S+|\n', text))]
+        self.sents, sent = [], []
+        for token in self.tokens:
+            sent.append(token)
+            if token.text.endswith('.'):
+                self.sents.append(sent)
+                sent = []
+        if len(sent) > 0:
+            self.sents.append(sent)
+        for sent in self.sents:
+            tokens = [token for token in sent if not token.is_space]
+            for token, head in zip(tokens[:-1], tokens[1:]):
+                token.head_i = head.i
+
+
+class FakeSpaCyModel(object):
+    """Stands in for a spaCy Language, parsing with FakeSpaCyDoc"""
+    def pipe(self, texts, batch_size=1000, **kwargs):
+        return (FakeSpaCyDoc(text) for text in texts)
+
+
+def fake_spacy(annotators=['tagger', 'parser', 'ner'], n_process=1):
+    """Returns a SpaCy parser using FakeSpaCyModel, without loading spaCy"""
+    parser = SpaCy.__new__(SpaCy)
+    Parser.__init__(parser, name='spaCy')
+    parser.annotators = annotators
+    parser.batch_size = 2
+    parser.n_process = n_process
+    parser.model = FakeSpaCyModel()
+    return parser
+
+
+def parse_in_daemon(parser, docs, queue):
+    try:
+        queue.put(len(list(parser.parse_batch(docs))))
+    except ValueError as e:
+        queue.put(str(e))
+
+
+class TestSpaCy(unittest.TestCase):
+
+    TEXTS = TestCoreNLPRequests.TEXTS + [u'Bob met\nAlice. \n']
+
+    def docs(self):
+        return [(Document(name='doc%d' % i, stable_id='doc%d::document:0:0' % i, meta={}), text)
+                for i, text in enumerate(self.TEXTS)]
+
+    def test_corenlp_format(self):
+        """Tests that the words, offsets, texts and stable ids of the sentences are those CoreNLP gives"""
+        corenlp = StanfordCoreNLPServer(urls=['http://127.0.0.1:1'])
+        corenlp._request = fake_corenlp_request
+        corenlp_docs, docs = self.docs(), self.docs()
+        expected = [p for doc, text in corenlp_docs for p in corenlp.parse(doc, text, None)]
+        parses = list(fake_spacy().connect().parse_batch(docs))
+        fields = ['words', 'char_offsets', 'text', 'position', 'stable_id']
+        self.assertEqual(len(parses), 8)
+        self.assertEqual([[p[f] for f in fields] for p in parses], [[p[f] for f in fields] for p in expected])
+        self.assertEqual([doc.meta for doc, _ in docs], [doc.meta for doc, _ in corenlp_docs])
+        self.assertEqual([p['document'].name for p in parses], [p['document'].name for p in expected])
+
+        # Dependency heads are 1-based indexes in the sentence, without whitespace tokens, with 0 for the root
+        for p in parses:
+            self.assertEqual(p['dep_parents'], list(range(2, len(p['words']) + 1)) + [0])
+            self.assertEqual(p['ner_tags'], ['PERSON' if w.istitle() else 'O' for w in p['words']])
+            self.assertEqual(p['pos_tags'], ['NN'] * len(p['words']))
+
+        # Whitespace tokens are dropped, as is a sentence of only whitespace
+        self.assertEqual((parses[-1]['words'], parses[-1]['text']), ([u'Bob', u'met', u'Alice.'], u'Bob met Alice.'))
+
+    def test_disabled_components(self):
+        """Tests that the fields of the components not run are left empty, rather than NULL"""
+        for p in fake_spacy(annotators=[]).parse_batch(self.docs()):
+            for field in ['pos_tags', 'ner_tags', 'dep_labels']:
+                self.assertEqual(p[field], [u''] * len(p['words']))
+            self.assertEqual(p['dep_parents'], [0] * len(p['words']))
+
+    def test_n_process_in_udf(self):
+        """Tests that parsing in several processes is refused in a daemonic process, such as a UDF process"""
+        queue = multiprocessing.Queue()
+        for n_process, result in [(1, 8), (2, 'n_process > 1')]:
+            process = multiprocessing.Process(target=parse_in_daemon, args=(fake_spacy(n_process=n_process),
+                                                                            self.docs(), queue))
+            process.daemon = True
+            process.start()
+            self.assertIn(str(result), str(queue.get(timeout=10)))
+            process.join()
+
+
+class TestXMLMultiDocPreprocessor(unittest.TestCase):
+
+    def test_streaming(self):
+        """Tests that streaming with iterparse yields the same documents as parsing the whole file"""
+        def docs(doc):
+            preprocessor = XMLMultiDocPreprocessor(path=ROOT + '/test/data/CDR_TestSet.xml', doc=doc,
+                text='.//passage/text/text()', id='.//id/text()', keep_xml_tree=True)
+            return [(d.name, d.stable_id, d.meta, text) for d, text in preprocessor]
+
+        streamed = docs('.//document')
+        self.assertEqual(len(streamed), 500)
+        self.assertEqual(streamed, docs('./document'))
+
+
+class TestHTMLDocPreprocessor(unittest.TestCase):
+
+    HTML = (b'<html>\n<head><title>Title</title><style>p {color: red}</style></head>\n<body>\n'
+            b'<script>var x = 1;</script>\n<h1>Heading</h1>\n<p>First <b>bold</b> paragraph.</p>\n'
+            b'<!-- A comment -->\n<p>Caf&eacute; second paragraph.</p>\n</body>\n</html>\n')
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        with open(os.path.join(self.path, 'page.html'), 'wb') as f:
+            f.write(self.HTML)
+
+    def docs(self, use_lxml):
+        preprocessor = HTMLDocPreprocessor(self.path, use_lxml=use_lxml)
+        return [(d.name, d.stable_id, d.meta, text) for d, text in preprocessor]
+
+    def test_lxml(self):
+        """Tests that the lxml text is the BeautifulSoup text, except for HTML comments"""
+        soup, = self.docs(use_lxml=False)
+        xml, = self.docs(use_lxml=True)
+        self.assertEqual(soup[3], 'Heading First  bold  paragraph.  A comment  Caf second paragraph.')
+        self.assertEqual(xml[3], 'Heading First  bold  paragraph. Caf second paragraph.')
+        self.assertEqual(xml[:3], soup[:3])
+
+
+class TestTikaPreprocessor(unittest.TestCase):
+
+    def test_lazy_import(self):
+        """Tests that importing snorkel.parser does not import tika, which starts a JVM"""
+        # A tika module that fails to import, so that the test does not depend on tika being installed
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        with open(os.path.join(path, 'tika.py'), 'w') as f:
+            f.write('raise ImportError("tika imported")\n')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([path, ROOT, os.environ.get('PYTHONPATH', '')]))
+        code = 'import sys, snorkel.parser; assert "tika" not in sys.modules'
+        self.assertEqual(subprocess.call([sys.executable, '-c', code], env=env), 0)
+
+
+class TestParallelDocPreprocessor(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # Files of several chunks, one chunk, and no Documents
+        cls.path = tempfile.mkdtemp()
+        for i, n in enumerate([250, 3, 0, 101, 40, 7]):
+            with open(os.path.join(cls.path, 'docs%d.tsv' % i), 'w') as f:
+                for j in range(n):
+                    f.write('doc%d_%d\tText %d of file %d.\n' % (i, j, j, i))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.path)
+
+    def docs(self, max_docs=float('inf'), **kwargs):
+        preprocessor = TSVDocPreprocessor(self.path, max_docs=max_docs, **kwargs)
+        return [(d.name, d.stable_id, d.meta, text) for d, text in preprocessor]
+
+    def test_ordered(self):
+        """Tests that parsing files in parallel yields the same Documents, in the same order, as generate()"""
+        expected = self.docs()
+        self.assertEqual(len(expected), 401)
+        self.assertEqual(self.docs(parallelism=3), expected)
+        self.assertEqual(self.docs(max_docs=120, parallelism=3), expected[:120])
+
+    def test_unordered(self):
+        """Tests that parsing files in parallel without ordering yields the same Documents as generate()"""
+        expected = self.docs()
+        self.assertEqual(sorted(self.docs(parallelism=3, ordered=False)), sorted(expected))
+        self.assertEqual(len(self.docs(max_docs=120, parallelism=3, ordered=False)), 120)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,507 @@
+import json, os, shutil, sys, tempfile, unittest
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from snorkel.candidates import CandidateExtractor, Ngrams, PretaggedCandidateExtractor
+from snorkel.matchers import DictionaryMatch
+from snorkel.models import Candidate, Checkpoint, Context, Document, Label, LabelKey, Sentence, Span, SnorkelSession, \
+    candidate_subclass
+from snorkel.parser import CorpusParser, RuleBasedParser
+import snorkel.udf
+from snorkel.udf import OutputWriter, bulk_insert
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.expression import Insert
+
+UDFTestPair = candidate_subclass('UDFTestPair', ['a', 'b'])
+
+TEXTS = [
+    u'Alice met Bob in Paris. Carol stayed home.',
+    u'Bob and Carol Smith wrote to Alice. Nobody answered.',
+    u'Dave called Alice Smith, then Bob. Alice was out.',
+    u'Carol and Dave met. Then Erin met Frank and Alice.'
+]
+
+NAMES = ['Alice', 'Bob', 'Carol', 'Carol Smith', 'Dave', 'Erin', 'Frank', 'Alice Smith']
+
+
+def clear_contexts(session):
+    session.query(Candidate).delete()
+    session.query(Context).delete()
+    session.commit()
+
+
+def make_docs(n=len(TEXTS), first=0):
+    """Returns (Document, text) pairs of a small corpus of n documents, numbered from first"""
+    return [(Document(name='udf_test%d' % i, stable_id='udf_test%d::document:0:0' % i, meta={}), TEXTS[i % len(TEXTS)])
+            for i in range(first, first + n)]
+
+
+def load_sentences():
+    """Returns the stored Sentences, detached from their session, as inputs to a UDF"""
+    session   = SnorkelSession()
+    sentences = session.query(Sentence).order_by(Sentence.id).all()
+    session.close()
+    return sentences
+
+
+class Preempted(Exception):
+    pass
+
+
+def preempt_checkpoint(session, n):
+    """Makes session raise Preempted instead of recording inputs in a checkpoint for the nth time"""
+    execute = session.execute
+    calls   = [0]
+    def preempted_execute(clause, *args, **kwargs):
+        if isinstance(clause, Insert) and clause.table is Checkpoint.__table__:
+            calls[0] += 1
+            if calls[0] == n:
+                raise Preempted()
+        return execute(clause, *args, **kwargs)
+    session.execute = preempted_execute
+
+
+def make_outputs():
+    """Returns a new Document with two Sentences, and Candidates over new Spans, as UDF outputs"""
+    doc   = Document(name='udf_test', stable_id='udf_test::document:0:0', meta={'file_name': 'udf_test'})
+    sents = [Sentence(document=doc, position=i, text=u'Alice met Bob .', words=[u'Alice', u'met', u'Bob', u'.'],
+                      char_offsets=[0, 6, 10, 14], stable_id='udf_test::sentence:%d:%d' % (16 * i, 16 * i + 15))
+             for i in range(2)]
+    spans = [Span(sentence=sent, char_start=start, char_end=end, stable_id='udf_test::span:%d:%d' % (16 * i + start,
+                  16 * i + end)) for i, sent in enumerate(sents) for start, end in [(0, 4), (10, 12)]]
+    cands = [UDFTestPair(a=spans[i], b=spans[i + 1], split=1) for i in range(0, len(spans), 2)]
+    return [doc] + sents + spans + cands
+
+
+def check_context_ids(test, session):
+    """Checks that each Context has a row of its type, and that each Sentence and Span links to the right one"""
+    contexts = dict(session.query(Context.id, Context.type))
+    for model, type in [(Document, 'document'), (Sentence, 'sentence'), (Span, 'span')]:
+        ids = [id for id, in session.query(model.__table__.c.id)]
+        test.assertEqual(sorted(ids), sorted(id for id, t in contexts.items() if t == type))
+    for sentence in session.query(Sentence):
+        test.assertTrue(sentence.stable_id.startswith(sentence.document.name + '::'))
+    for span in session.query(Span):
+        test.assertEqual(span.get_span(), span.sentence.text[span.char_start:span.char_end + 1])
+
+
+def stored_outputs(session):
+    """Returns the stored Contexts and Candidates, by stable_id, and their links to each other"""
+    docs  = [(d.stable_id, d.name, d.meta) for d in session.query(Document)]
+    sents = [(s.stable_id, s.document.stable_id, s.position, s.words) for s in session.query(Sentence)]
+    spans = [(s.stable_id, s.sentence.stable_id, s.char_start, s.char_end) for s in session.query(Span)]
+    cands = [(c.type, c.split, c.a.stable_id, c.b.stable_id) for c in session.query(UDFTestPair)]
+    return sorted(docs), sorted(sents), sorted(spans), sorted(cands)
+
+
+class TestOutputWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.session = SnorkelSession()
+        clear_contexts(self.session)
+
+    def tearDown(self):
+        clear_contexts(self.session)
+        self.session.close()
+
+    def test_bulk_insert(self):
+        """Tests that bulk_insert stores the same rows, linked the same way, as adding the objects to a session"""
+        self.session.add_all(make_outputs())
+        self.session.commit()
+        expected = stored_outputs(self.session)
+        self.assertEqual([len(rows) for rows in expected], [1, 2, 4, 2])
+        clear_contexts(self.session)
+
+        # Outputs may come in any order; objects they reference are inserted first
+        outputs = make_outputs()
+        bulk_insert(self.session, outputs[::-1])
+        self.session.commit()
+        self.assertEqual(stored_outputs(self.session), expected)
+        ids = [id for id, in self.session.query(Context.id)] + [id for id, in self.session.query(Candidate.id)]
+        self.assertEqual(sorted(o.id for o in outputs), sorted(ids))
+
+    def test_flush_size(self):
+        """Tests that OutputWriter commits at the end of the batch after flush_size outputs"""
+        writer = OutputWriter(self.session, flush_size=3)
+        n_docs = lambda: SnorkelSession().query(Document).count()
+        for i in range(5):
+            writer.write(Document(name='udf_test%d' % i, stable_id='udf_test%d::document:0:0' % i, meta={}))
+            writer.done()
+            self.assertEqual(n_docs(), 3 if i >= 2 else 0)
+        writer.flush()
+        self.assertEqual(n_docs(), 5)
+
+    def test_default_flush_size(self):
+        """Tests that with no flush policy set, outputs are flushed every WRITER_COMMIT_SIZE, not only at the end"""
+        flushes, flush, commit_size = [], OutputWriter.flush, snorkel.udf.WRITER_COMMIT_SIZE
+        def counted_flush(writer):
+            flushes.append(len(writer.buffer))
+            flush(writer)
+        OutputWriter.flush, snorkel.udf.WRITER_COMMIT_SIZE = counted_flush, 3
+        try:
+            CorpusParser(parser=RuleBasedParser()).apply(make_docs(), progress_bar=False)
+        finally:
+            OutputWriter.flush, snorkel.udf.WRITER_COMMIT_SIZE = flush, commit_size
+        self.assertGreater(len([n for n in flushes if n > 0]), 1)
+        self.assertTrue(all(n <= 4 for n in flushes))
+        self.assertEqual(self.session.query(Sentence).count(), 8)
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.session = SnorkelSession()
+        clear_contexts(self.session)
+
+    def tearDown(self):
+        clear_contexts(self.session)
+        self.session.query(Checkpoint).delete()
+        self.session.commit()
+        self.session.close()
+
+    def parse(self, **kwargs):
+        parser = CorpusParser(parser=RuleBasedParser())
+        parser.apply(make_docs(), checkpoint='udf_test', flush_size=1, progress_bar=False, **kwargs)
+        return parser
+
+    def test_resume(self):
+        """Tests that a run interrupted between writing outputs and recording their inputs resumes without duplicates"""
+        self.parse()
+        expected = stored_outputs(self.session)[:2]
+        self.assertEqual(self.session.query(Checkpoint).count(), 0)
+        clear_contexts(self.session)
+
+        # The run is killed while recording the inputs of the third flush, so that transaction is rolled back
+        parser = CorpusParser(parser=RuleBasedParser())
+        preempt_checkpoint(parser.reducer.session, 3)
+        with self.assertRaises(Preempted):
+            parser.apply(make_docs(), checkpoint='udf_test', flush_size=1, progress_bar=False)
+        parser.reducer.session.rollback()
+        self.assertEqual(self.session.query(Document).count(), 2)
+        self.assertEqual(self.session.query(Checkpoint).count(), 2)
+
+        # Resuming skips the inputs recorded, and processes the others once
+        stats = self.parse().stats
+        self.assertEqual(stats.total().n_inputs, 2)
+        self.assertEqual(stored_outputs(self.session)[:2], expected)
+        self.assertEqual(self.session.query(Checkpoint).count(), 0)
+
+
+class TestCorpusParser(unittest.TestCase):
+
+    def setUp(self):
+        self.session = SnorkelSession()
+        clear_contexts(self.session)
+
+    def tearDown(self):
+        clear_contexts(self.session)
+        self.session.close()
+
+    def test_bulk_insert(self):
+        """Tests that inserting the parsed Sentences in bulk stores the same rows as adding them to a session"""
+        connection = RuleBasedParser().connect()
+        for doc, text in make_docs():
+            self.session.add_all(Sentence(**parts) for parts in connection.parse(doc, text))
+        self.session.commit()
+        expected = stored_outputs(self.session)[:2]
+        self.assertEqual([len(rows) for rows in expected], [4, 8])
+        clear_contexts(self.session)
+
+        CorpusParser(parser=RuleBasedParser()).apply(make_docs(), progress_bar=False)
+        self.assertEqual(stored_outputs(self.session)[:2], expected)
+        check_context_ids(self, self.session)
+
+        # The ids of a second batch follow those already assigned
+        CorpusParser(parser=RuleBasedParser()).apply(make_docs(first=4), clear=False, progress_bar=False)
+        self.assertEqual(self.session.query(Document).count(), 8)
+        self.assertEqual(self.session.query(Sentence).count(), 16)
+        check_context_ids(self, self.session)
+
+
+    def test_incremental(self):
+        """Tests that incremental parsing only adds the new Documents, keeping the existing Sentences"""
+        CorpusParser(parser=RuleBasedParser()).apply(make_docs(), progress_bar=False)
+        ids = sorted(id for id, in self.session.query(Sentence.id))
+
+        parser = CorpusParser(parser=RuleBasedParser())
+        parser.apply(make_docs(6), incremental=True, batch_size=4, progress_bar=False)
+        self.assertEqual(parser.stats.total().n_outputs, 4)
+        self.assertEqual(self.session.query(Document).count(), 6)
+        self.assertEqual(sorted(id for id, in self.session.query(Sentence.id))[:len(ids)], ids)
+        check_context_ids(self, self.session)
+        self.assertEqual(stored_outputs(self.session)[:2], self.parsed(make_docs(6)))
+
+    def parsed(self, docs):
+        """Returns the stored outputs of parsing docs from scratch, then clears them"""
+        clear_contexts(self.session)
+        CorpusParser(parser=RuleBasedParser()).apply(docs, progress_bar=False)
+        outputs = stored_outputs(self.session)[:2]
+        clear_contexts(self.session)
+        return outputs
+
+
+class TestCandidateExtraction(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.session = SnorkelSession()
+        CorpusParser(parser=RuleBasedParser()).apply(make_docs(), progress_bar=False)
+        cls.sentences = load_sentences()
+
+    @classmethod
+    def tearDownClass(cls):
+        clear_contexts(cls.session)
+        cls.session.close()
+
+    def extract(self, extractor=None, sentences=None, **kwargs):
+        """Extracts UDFTestPair Candidates of names, returning the stored Spans and Candidates"""
+        self.session.query(Context).filter(Context.type == 'span').delete()
+        self.session.commit()
+        extractor = extractor or CandidateExtractor(UDFTestPair, [Ngrams(n_max=2)] * 2, [DictionaryMatch(d=NAMES)] * 2)
+        extractor.apply(self.sentences if sentences is None else sentences, split=0, progress_bar=False, **kwargs)
+        return stored_outputs(self.session)[2:]
+
+    def test_span_ids(self):
+        """Tests that inserting Spans in batches stores the same rows as inserting them one by one"""
+        self.session.query(Context).filter(Context.type == 'span').delete()
+        matcher = DictionaryMatch(d=NAMES)
+        for sentence in self.session.query(Sentence):
+            for tc in set(matcher.apply(Ngrams(n_max=2).apply(sentence))):
+                tc.load_id_or_insert(self.session)
+        self.session.commit()
+        expected = stored_outputs(self.session)[2]
+        self.assertEqual(len(expected), 15)
+
+        spans, cands = self.extract()
+        self.assertEqual(spans, expected)
+        check_context_ids(self, self.session)
+
+        # Spans of later batches, inserted with some of their Sentence's Spans already stored, get new ids
+        self.session.query(Context).filter(Context.type == 'span').delete()
+        self.session.commit()
+        extractor = CandidateExtractor(UDFTestPair, [Ngrams(n_max=2)] * 2, [DictionaryMatch(d=NAMES)] * 2)
+        for sentences in [self.sentences[:3], self.sentences[1:6], self.sentences]:
+            extractor.apply(sentences, split=0, clear=False, batch_size=2, progress_bar=False)
+        self.assertEqual(stored_outputs(self.session)[2:], (spans, cands))
+        check_context_ids(self, self.session)
+
+    def test_parallel(self):
+        """Tests that running in parallel, streaming the inputs through a small queue, stores the same outputs"""
+        expected = self.extract()
+        self.assertEqual(self.extract(parallelism=2, max_queue_size=1), expected)
+        self.assertEqual(self.extract(sentences=iter(self.sentences), parallelism=3, max_queue_size=1), expected)
+
+    def test_batches(self):
+        """Tests that passing the inputs to apply_batch in batches stores the same outputs"""
+        expected  = self.extract()
+        extractor = CandidateExtractor(UDFTestPair, [Ngrams(n_max=2)] * 2, [DictionaryMatch(d=NAMES)] * 2)
+        self.assertEqual(self.extract(extractor, batch_size=3), expected)
+        self.assertEqual(extractor.stats.total().n_batches, 3)
+        self.assertEqual(self.extract(parallelism=2, batch_size=3), expected)
+
+    def test_thread_backend(self):
+        """Tests that running the UDFs on threads stores the same outputs as running them in one process"""
+        expected = self.extract()
+        self.assertEqual(self.extract(parallelism=2, backend='thread'), expected)
+        self.assertEqual(self.extract(parallelism=2, backend='thread', batch_size=3), expected)
+        with self.assertRaises(ValueError):
+            self.extract(parallelism=2, backend='greenlet')
+
+    def test_keep_alive(self):
+        """Tests that UDF processes kept alive across apply calls store the same outputs each time"""
+        expected = self.extract()
+        for backend in ['process', 'thread']:
+            extractor = CandidateExtractor(UDFTestPair, [Ngrams(n_max=2)] * 2, [DictionaryMatch(d=NAMES)] * 2)
+            try:
+                self.assertEqual(self.extract(extractor, parallelism=2, keep_alive=True, backend=backend), expected)
+                udfs = list(extractor.udfs)
+                self.assertTrue(all(udf.is_alive() for udf in udfs))
+                self.assertEqual(self.extract(extractor, parallelism=2, keep_alive=True, backend=backend), expected)
+                self.assertEqual(extractor.udfs, udfs)
+            finally:
+                extractor.close()
+            self.assertFalse(any(udf.is_alive() for udf in udfs))
+
+    def test_stats(self):
+        """Tests that the stats of a run count the inputs and outputs of each worker, and are written as JSON"""
+        path = tempfile.mkdtemp()
+        try:
+            extractor = CandidateExtractor(UDFTestPair, [Ngrams(n_max=2)] * 2, [DictionaryMatch(d=NAMES)] * 2)
+            spans, cands = self.extract(extractor, batch_size=3, stats_path=os.path.join(path, 'stats.jsonl'))
+            stats = extractor.stats
+            self.assertTrue(stats.completed)
+            self.assertEqual([w.worker for w in stats.workers], ['main'])
+            self.assertEqual((stats.total().n_batches, stats.total().n_inputs), (3, 8))
+            self.assertEqual(stats.total().n_outputs, len(cands))
+
+            # In single-writer mode, the writer counts no inputs, but the new Spans are outputs too
+            self.extract(extractor, parallelism=2, batch_size=3, stats_path=os.path.join(path, 'stats.jsonl'))
+            stats = extractor.stats
+            self.assertEqual([w.worker for w in stats.workers], ['writer', 0, 1])
+            self.assertEqual(stats.workers[0].n_inputs, 0)
+            self.assertEqual((stats.total().n_batches, stats.total().n_inputs), (3, 8))
+            self.assertEqual(stats.total().n_outputs, len(spans) + len(cands))
+
+            with open(os.path.join(path, 'stats.jsonl')) as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual([d['worker'] for d in lines], ['main', 'total', 'writer', 0, 1, 'total'])
+            self.assertEqual([d['n_inputs'] for d in lines if d['worker'] == 'total'], [8, 8])
+        finally:
+            shutil.rmtree(path)
+
+    def test_progress(self):
+        """Tests that the progress of a parallel run is passed to progress_callback, up to all the inputs"""
+        updates = []
+        self.extract(parallelism=2, batch_size=3, progress_callback=updates.append)
+        self.assertGreater(len(updates), 0)
+        progress = updates[-1]
+        self.assertEqual((progress.n_done, progress.n_total), (8, 8))
+        self.assertEqual(sum(w['n_inputs'] for w in progress.workers), 8)
+        self.assertEqual([w['worker'] for w in progress.workers], [0, 1])
+        self.assertEqual(progress.eta, 0)
+
+        # Without a length, there is no ETA
+        updates = []
+        self.extract(sentences=iter(self.sentences), parallelism=2, progress_callback=updates.append)
+        self.assertEqual((updates[-1].n_done, updates[-1].n_total, updates[-1].eta), (8, None, None))
+
+    def test_existing_candidates(self):
+        """Tests that extracting again without clearing adds no Candidates, checking with one query per batch"""
+        spans, cands = self.extract()
+        statements = []
+        def count_selects(conn, cursor, statement, *args):
+            if statement.startswith('SELECT') and 'FROM %s' % UDFTestPair.__tablename__ in statement:
+                statements.append(statement)
+        event.listen(Engine, 'before_cursor_execute', count_selects)
+        try:
+            extractor = CandidateExtractor(UDFTestPair, [Ngrams(n_max=2)] * 2, [DictionaryMatch(d=NAMES)] * 2)
+            extractor.apply(self.sentences, split=0, clear=False, batch_size=3, progress_bar=False)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', count_selects)
+        self.assertEqual(stored_outputs(self.session)[2:], (spans, cands))
+        self.assertEqual(extractor.stats.total().n_outputs, 0)
+        self.assertEqual(len(statements), 3)
+
+    def test_label_annotator(self):
+        """Tests that labeling in parallel, reducing the Labels in batches, stores the same Labels"""
+        from snorkel.annotations import LabelAnnotator
+        self.extract()
+        def lf_alice(c):
+            return 1 if 'Alice' in c.a.get_span() else None
+        def lf_order(c):
+            return -1 if c.a.char_start > c.b.char_start else 0
+        def lf_order_flipped(c):
+            return 1 if c.a.char_start > c.b.char_start else -1
+        lf_order_flipped.__name__ = 'lf_order'
+        def labels():
+            q = self.session.query(Label.candidate_id, LabelKey.name, Label.value).join(LabelKey, Label.key_id == LabelKey.id)
+            return sorted(q)
+
+        try:
+            LabelAnnotator(lfs=[lf_alice, lf_order]).apply(split=0, progress_bar=False)
+            expected = labels()
+            self.assertEqual(len(set(name for _, name, _ in expected)), 2)
+            LabelAnnotator(lfs=[lf_alice, lf_order]).apply(split=0, parallelism=2, batch_size=3, progress_bar=False)
+            self.assertEqual(labels(), expected)
+
+            # Without clearing, existing Labels are updated, and new ones inserted
+            LabelAnnotator(lfs=[lf_order_flipped]).apply(split=0, progress_bar=False)
+            flipped = labels()
+            LabelAnnotator(lfs=[lf_alice, lf_order]).apply(split=0, progress_bar=False)
+            LabelAnnotator(lfs=[lf_order_flipped]).apply_existing(split=0, clear=False, parallelism=2, batch_size=3,
+                                                                  progress_bar=False)
+            self.assertEqual([l for l in labels() if l[1] == 'lf_order'], flipped)
+            self.assertEqual([l for l in labels() if l[1] == 'lf_alice'],
+                             [l for l in expected if l[1] == 'lf_alice'])
+        finally:
+            self.session.query(Label).delete()
+            self.session.query(LabelKey).delete()
+            self.session.commit()
+
+    def test_flush_policy(self):
+        """Tests that flushing outputs every few outputs or seconds stores the same outputs, also in parallel"""
+        expected = self.extract()
+        self.assertEqual(self.extract(flush_size=5), expected)
+        self.assertEqual(self.extract(parallelism=2, flush_size=5), expected)
+        self.assertEqual(self.extract(parallelism=2, backend='thread', batch_size=3, flush_secs=0), expected)
+
+    def test_single_writer(self):
+        """Tests that single-writer mode stores the same Spans and Candidates, including the Spans of no Candidate"""
+        spans, cands = self.extract()
+        self.assertEqual(len(spans), 15)
+        self.assertEqual(len(cands), 22)
+        self.assertGreater(len(spans), len(set(c[2] for c in cands) | set(c[3] for c in cands)))
+        self.assertEqual(self.extract(parallelism=2, single_writer=True), (spans, cands))
+
+
+    def test_pretagged(self):
+        """Tests that extracting pre-tagged entities stores the same outputs, checking with one query per batch"""
+        persons   = [name for name in NAMES if ' ' not in name]
+        sentences = load_sentences()
+        for sentence in sentences:
+            sentence.entity_types = ['person' if w in persons else None for w in sentence.words]
+            sentence.entity_cids  = [w if w in persons else None for w in sentence.words]
+        expected = self.extract(CandidateExtractor(UDFTestPair, [Ngrams(n_max=1)] * 2, [DictionaryMatch(d=persons)] * 2))
+        self.assertGreater(len(expected[1]), 0)
+
+        extractor = PretaggedCandidateExtractor(UDFTestPair, ['person', 'person'])
+        self.assertEqual(self.extract(extractor, sentences=sentences), expected)
+        for c in self.session.query(UDFTestPair):
+            self.assertEqual(c.get_cids(), (c.a.get_span(), c.b.get_span()))
+        self.assertEqual(self.extract(extractor, sentences=sentences, batch_size=3), expected)
+        self.assertEqual(extractor.stats.total().n_batches, 3)
+        self.assertEqual(self.extract(extractor, sentences=sentences, parallelism=2, batch_size=3), expected)
+
+        statements = []
+        def count_selects(conn, cursor, statement, *args):
+            if statement.startswith('SELECT') and 'FROM %s' % UDFTestPair.__tablename__ in statement:
+                statements.append(statement)
+        event.listen(Engine, 'before_cursor_execute', count_selects)
+        try:
+            extractor.apply(sentences, split=0, clear=False, batch_size=3, progress_bar=False)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', count_selects)
+        self.assertEqual(stored_outputs(self.session)[2:], expected)
+        self.assertEqual(extractor.stats.total().n_outputs, 0)
+        self.assertEqual(len(statements), 3)
+
+
+class TestAnnotatorUDF(unittest.TestCase):
+
+    def setUp(self):
+        self.session = SnorkelSession()
+
+    def tearDown(self):
+        self.session.query(Checkpoint).delete()
+        self.session.query(LabelKey).delete()
+        self.session.commit()
+        self.session.close()
+
+    def test_key_race(self):
+        """Tests that a key added concurrently is picked up, keeping what was written before in the transaction"""
+        from snorkel.annotations import AnnotatorUDF
+        udf, other = AnnotatorUDF(Label, LabelKey, None), AnnotatorUDF(Label, LabelKey, None)
+        self.addCleanup(udf.session.close)
+        self.addCleanup(other.session.close)
+
+        # Once the first UDF has looked up its keys, the other adds lf_b, and the first writes a ledger row
+        execute = udf.session.execute
+        def racing_execute(clause, *args, **kwargs):
+            if isinstance(clause, Insert) and udf.session.execute is racing_execute:
+                udf.session.execute = execute
+                other._get_key_ids(['lf_b'], 0, True)
+                other.session.commit()
+                execute(Checkpoint.__table__.insert(), {'name': 'udf_test', 'key': 'x'})
+            return execute(clause, *args, **kwargs)
+        udf.session.execute = racing_execute
+        key_ids = udf._get_key_ids(['lf_a', 'lf_b'], 0, True)
+        self.assertEqual(key_ids['lf_b'], other.key_cache['lf_b'])
+
+        # The ledger row and lf_a are still part of the transaction, and are committed with it
+        self.assertEqual(self.session.query(Checkpoint).count(), 0)
+        udf.session.commit()
+        self.assertEqual(self.session.query(Checkpoint).count(), 1)
+        self.assertEqual(dict(self.session.query(LabelKey.name, LabelKey.id)), key_ids)
+
+
+if __name__ == '__main__':
+    unittest.main()